@@ -0,0 +1,561 @@
+'''simulated zfs and zpool commands, for benchmarking and testing zgit
+without real pools.  Usage:
+
+  python fakezfs.py init STATEFILE [--pools N --filesystems M --snapshots K]
+  python fakezfs.py install BINDIR   # write zfs, zpool scripts to put on PATH
+
+The state file (given by FAKEZFS_STATE) holds a synthetic model of
+N pools x M filesystems (poolP/fsF), where all copies of fsF share one
+lineage of K snapshot GUIDs, pool0 holding all K of them and the other
+pools lagging a few behind.  Model datasets are generated on demand, and
+only the changes made to them by snapshot, destroy, receive etc. are
+stored, so that the state file stays small at any scale.'''
+
+import sys
+import os
+import json
+import time
+import fcntl
+import argparse
+
+STATEPATH = os.environ.get('FAKEZFS_STATE', 'fakezfs.json')
+START_TIME = 1500000000 # creation time of first model snapshot
+FEATURES = ('lz4_compress', 'embedded_data', 'large_blocks', 'encryption')
+
+def lineage_guid(seed, f, k):
+    'get GUID of snapshot k of lineage f; distinct for all (seed, f, k)'
+    return (((seed << 42) + (f << 21) + k + 1) * 0x9E3779B97F4A7C15) & ((1 << 63) - 1)
+
+def get_lag(p, f):
+    'number of snapshots that poolP/fsF is behind pool0/fsF'
+    return p and (p + f) % 4 or 0
+
+class ZfsModel(object):
+    'datasets of the synthetic model, plus all changes made to them'
+    def __init__(self, path=STATEPATH):
+        self.path = path
+        self.lockFile = None
+        self.datasets = {} # dataset dicts used by this command
+        self.edited = set()
+        self.created = set()
+
+    def lock(self):
+        'serialize changes made by concurrent zfs commands'
+        if self.lockFile is None:
+            self.lockFile = open(self.path + '.lock', 'a')
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+
+    def load(self):
+        with open(self.path) as ifile:
+            self.state = json.load(ifile)
+        self.model = self.state['model']
+        self.datasets.clear()
+
+    def save(self):
+        'save edited datasets, as changes to the model where possible'
+        for name in self.edited:
+            d = self.datasets[name]
+            entry = self.state['ds'].get(name)
+            if name in self.model_index() and name not in self.created \
+               and (entry is None or entry.get('delta')):
+                names = set([s['name'] for s in d['snaps']])
+                model = set([s['name'] for s in self.generate(name)['snaps']])
+                entry = dict(d, delta=True,
+                             destroyed=sorted(model - names),
+                             snaps=[s for s in d['snaps'] if s['name'] not in model])
+            else:
+                entry = d
+            self.state['ds'][name] = entry
+        with open(self.path + '.tmp', 'w') as ofile:
+            json.dump(self.state, ofile)
+        os.rename(self.path + '.tmp', self.path)
+
+    def model_names(self):
+        'get names of all datasets in the model'
+        pools = ['pool%d' % p for p in range(self.model['pools'])]
+        return pools + ['%s/fs%d' % (pool, f) for pool in pools
+                        for f in range(self.model['filesystems'])]
+
+    def names(self):
+        'get sorted names of all datasets on online pools'
+        offline = set(self.state.get('offline', ()))
+        names = set(self.model_names()) - set(self.state['deleted'])
+        names.update(self.state['ds'])
+        return sorted([name for name in names if name.split('/')[0] not in offline])
+
+    def exists(self, name):
+        if name in self.state['ds']:
+            return True
+        return name not in self.state['deleted'] and name in self.model_index()
+
+    def model_index(self):
+        try:
+            return self.modelIndex
+        except AttributeError:
+            self.modelIndex = set(self.model_names())
+            return self.modelIndex
+
+    def generate(self, name):
+        'get dataset dict of model dataset name'
+        l = name.split('/')
+        p = int(l[0][4:])
+        d = dict(snaps=[], written=0,
+                 mountpoint=self.model.get('mountRoot', '') + '/' + name)
+        if len(l) == 1:
+            return d
+        f = int(l[1][2:])
+        seed = self.model['seed']
+        commitMsg = 'backup latest changes'
+        d['snaps'] = [dict(name='s%05d' % k, guid=str(lineage_guid(seed, f, k)),
+                           createtxg=k + 2, creation=START_TIME + 3600 * k,
+                           size=1000 * ((7 * f + k) % 10 + 1),
+                           props={'org.zgit:commitmsg':commitMsg})
+                      for k in range(self.model['snapshots'] - get_lag(p, f))]
+        if p == 0 and f % 2 == 0: # half the sources have uncommitted changes
+            d['written'] = self.model.get('written', 4096)
+        return d
+
+    def get(self, name):
+        'get dataset dict of name, or None if it does not exist'
+        try:
+            return self.datasets[name]
+        except KeyError:
+            pass
+        entry = self.state['ds'].get(name)
+        if entry is None and not self.exists(name):
+            return None
+        if entry is None:
+            d = self.generate(name)
+        elif entry.get('delta'): # apply changes to model dataset
+            d = self.generate(name)
+            destroyed = set(entry['destroyed'])
+            d.update([(k, v) for k, v in entry.items()
+                      if k not in ('delta', 'destroyed', 'snaps')])
+            d['snaps'] = [s for s in d['snaps'] if s['name'] not in destroyed] \
+                         + entry['snaps']
+        else:
+            d = entry
+        self.datasets[name] = d
+        return d
+
+    def edit(self, name):
+        'get dataset dict of name, stored so that changes to it are saved'
+        d = self.get(name)
+        if d is None:
+            die("cannot open '%s': dataset does not exist" % name)
+        self.edited.add(name)
+        return d
+
+    def create(self, name, d=None):
+        if d is None:
+            d = dict(snaps=[], written=0)
+        d.setdefault('mountpoint', self.model.get('mountRoot', '') + '/' + name)
+        self.state['ds'][name] = self.datasets[name] = d
+        self.created.add(name)
+        self.edited.add(name)
+        if name in self.state['deleted']:
+            self.state['deleted'].remove(name)
+        return d
+
+    def delete(self, name):
+        self.state['ds'].pop(name, None)
+        self.datasets.pop(name, None)
+        self.edited.discard(name)
+        if name in self.model_index():
+            self.state['deleted'].append(name)
+
+    def next_txg(self):
+        self.state['txg'] += 1
+        return self.state['txg']
+
+    def find_snap(self, name):
+        'get (dataset dict, index of snapshot) for fs@snap'
+        fs, snap = name.split('@')
+        d = self.get(fs)
+        if d is not None:
+            for i, s in enumerate(d['snaps']):
+                if s['name'] == snap:
+                    return d, i
+        die("cannot open '%s': dataset does not exist" % name)
+
+def die(msg, status=1):
+    sys.stderr.write(msg + '\n')
+    sys.exit(status)
+
+def init_state(path, pools=2, filesystems=10, snapshots=100, seed=1,
+               mountRoot='', written=4096):
+    'write a fresh state file for this model'
+    state = dict(model=dict(pools=pools, filesystems=filesystems,
+                            snapshots=snapshots, seed=seed, mountRoot=mountRoot,
+                            written=written),
+                 txg=snapshots + 10, ds={}, deleted=[], offline=[])
+    with open(path, 'w') as ofile:
+        json.dump(state, ofile)
+
+def get_backup_map(pools=2, filesystems=10):
+    'get zgit backupMap syncing each pool0/fsF to its copy on every other pool'
+    return dict([('pool0/fs%d' % f, [['backup%d' % p, 'pool%d/fs%d' % (p, f)]
+                                      for p in range(1, pools)])
+                 for f in range(filesystems)])
+
+def install(binDir, python=sys.executable):
+    'write zfs and zpool scripts running this module into binDir'
+    script = os.path.abspath(__file__).replace('.pyc', '.py')
+    for prog in ('zfs', 'zpool'):
+        path = os.path.join(binDir, prog)
+        with open(path, 'w') as ofile:
+            ofile.write('#!/bin/sh\nexec %s %s %s "$@"\n' % (python, script, prog))
+        os.chmod(path, 0755)
+
+
+#########################################################################
+# zfs subcommands
+
+def get_snap_value(s, name, prop, parsable=False):
+    'get property value of snapshot dict s, named name'
+    if prop == 'name':
+        return name
+    elif prop in ('guid', 'createtxg'):
+        return str(s[prop])
+    elif prop == 'creation':
+        if parsable:
+            return str(s['creation'])
+        return time.strftime('%a %b %d %H:%M %Y', time.localtime(s['creation']))
+    elif prop == 'used':
+        return str(s['size'])
+    return s.get('props', {}).get(prop, '-')
+
+def get_value(zfs, name, prop, parsable=False):
+    'get property value of dataset or snapshot name'
+    if '@' in name:
+        d, i = zfs.find_snap(name)
+        return get_snap_value(d['snaps'][i], name, prop, parsable)
+    d = zfs.get(name)
+    if prop == 'name':
+        return name
+    elif prop in ('mountpoint', 'written'):
+        return str(d[prop])
+    elif prop == 'receive_resume_token':
+        return d.get('token', '-')
+    elif prop in ('guid', 'createtxg', 'creation', 'used'):
+        return '0'
+    return d.get('props', {}).get(prop, '-')
+
+def find_mounted(zfs, path):
+    'get name of the dataset whose mountpoint contains path, or None'
+    best = None
+    for name in zfs.names():
+        mountpoint = zfs.get(name)['mountpoint']
+        if path == mountpoint or path.startswith(mountpoint + '/'):
+            if best is None or len(mountpoint) > len(best[1]):
+                best = (name, mountpoint)
+    return best and best[0]
+
+def cmd_list(zfs, args):
+    parser = argparse.ArgumentParser(prog='zfs list')
+    parser.add_argument('-H', action='store_true')
+    parser.add_argument('-p', action='store_true')
+    parser.add_argument('-r', action='store_true')
+    parser.add_argument('-d', type=int)
+    parser.add_argument('-t', default='filesystem,volume')
+    parser.add_argument('-o', default='name,used,avail,refer,mountpoint')
+    parser.add_argument('-s')
+    parser.add_argument('names', nargs='*')
+    args = parser.parse_args(args)
+    types = args.t.split(',')
+    if 'all' in types:
+        types = ['filesystem', 'volume', 'snapshot']
+    columns = args.o.split(',')
+    status = 0
+    roots = None
+    depth = args.d
+    if args.names:
+        roots = []
+        for name in args.names:
+            fs = name.startswith('/') and find_mounted(zfs, name) or name
+            if fs and zfs.exists(fs):
+                roots.append(fs)
+            else:
+                sys.stderr.write("cannot open '%s': dataset does not exist\n" % name)
+                status = 1
+        if depth is None and not args.r: # just the named datasets
+            depth = 'snapshot' in types and 1 or 0
+    write = sys.stdout.write
+    for fs in zfs.names():
+        if roots is not None:
+            levels = [fs[len(root):].count('/') for root in roots
+                      if fs == root or fs.startswith(root + '/')]
+            if not levels or (depth is not None and min(levels) > depth):
+                continue
+            snapsShown = depth is None or min(levels) < depth
+        else:
+            snapsShown = True
+        if 'filesystem' in types or 'volume' in types:
+            write('\t'.join([get_value(zfs, fs, c, args.p) for c in columns]) + '\n')
+        if 'snapshot' in types and snapsShown:
+            for s in zfs.get(fs)['snaps']:
+                name = fs + '@' + s['name']
+                write('\t'.join([get_snap_value(s, name, c, args.p)
+                                 for c in columns]) + '\n')
+    sys.exit(status)
+
+def cmd_get(zfs, args):
+    parser = argparse.ArgumentParser(prog='zfs get')
+    parser.add_argument('-H', action='store_true')
+    parser.add_argument('-p', action='store_true')
+    parser.add_argument('-o', default='name,property,value,source')
+    parser.add_argument('props')
+    parser.add_argument('names', nargs='+')
+    args = parser.parse_args(args)
+    columns = args.o.split(',')
+    status = 0
+    for name in args.names:
+        if not zfs.exists(name.split('@')[0]):
+            sys.stderr.write("cannot open '%s': dataset does not exist\n" % name)
+            status = 1
+            continue
+        for prop in args.props.split(','):
+            row = dict(name=name, property=prop, source='-',
+                       value=get_value(zfs, name, prop, args.p))
+            print '\t'.join([row[c] for c in columns])
+    sys.exit(status)
+
+def cmd_snapshot(zfs, args):
+    props = {}
+    while args[0] == '-o':
+        prop, value = args[1].split('=', 1)
+        props[prop] = value
+        args = args[2:]
+    if len(set([name.split('/')[0] for name in args])) > 1:
+        die('cannot create snapshots : cross-pool snapshots are not allowed')
+    txg = zfs.next_txg()
+    for name in args:
+        fs, snap = name.split('@')
+        d = zfs.edit(fs)
+        if snap in [s['name'] for s in d['snaps']]:
+            die("cannot create snapshot '%s': dataset already exists" % name)
+        d['snaps'].append(dict(name=snap, guid=str(lineage_guid(txg, len(d['snaps']),
+                                                               hash(fs) & 0xfffff)),
+                               createtxg=txg, creation=int(time.time()),
+                               size=d['written'], props=dict(props)))
+        d['written'] = 0
+    zfs.save()
+
+def cmd_destroy(zfs, args):
+    flags = ''.join([a[1:] for a in args if a.startswith('-')])
+    name = [a for a in args if not a.startswith('-')][0]
+    if '@' not in name:
+        if not zfs.exists(name):
+            die("cannot open '%s': dataset does not exist" % name)
+        zfs.delete(name)
+        zfs.save()
+        return
+    fs, spec = name.split('@')
+    d = zfs.edit(fs)
+    names = [s['name'] for s in d['snaps']]
+    doomed = set()
+    for part in spec.split(','):
+        if '%' in part: # range of snapshots
+            first, last = part.split('%')
+            try:
+                doomed.update(names[first and names.index(first) or 0:
+                                    last and names.index(last) + 1 or len(names)])
+            except ValueError:
+                die("could not find any snapshots to destroy; check snapshot names.")
+        elif part in names:
+            doomed.add(part)
+        else:
+            die("could not find any snapshots to destroy; check snapshot names.")
+    reclaim = sum([s['size'] for s in d['snaps'] if s['name'] in doomed])
+    if 'v' in flags:
+        for snap in names:
+            if snap in doomed:
+                print ('p' in flags and 'destroy\t%s@%s' or 'would destroy %s@%s') \
+                      % (fs, snap)
+        print ('p' in flags and 'reclaim\t%d' or 'would reclaim %d') % reclaim
+    if 'n' not in flags:
+        d['snaps'] = [s for s in d['snaps'] if s['name'] not in doomed]
+        zfs.next_txg()
+        zfs.save()
+
+def cmd_create(zfs, args):
+    name = args[-1]
+    if zfs.exists(name):
+        die("cannot create '%s': dataset already exists" % name)
+    if not zfs.exists(name.rsplit('/', 1)[0]):
+        die("cannot create '%s': parent does not exist" % name)
+    zfs.create(name)
+    zfs.save()
+
+def cmd_set(zfs, args):
+    prop, value = args[0].split('=', 1)
+    zfs.edit(args[1]).setdefault('props', {})[prop] = value
+    zfs.save()
+
+def cmd_rollback(zfs, args):
+    d, i = zfs.find_snap(args[-1])
+    d = zfs.edit(args[-1].split('@')[0])
+    del d['snaps'][i + 1:]
+    d['written'] = 0
+    zfs.save()
+
+def cmd_diff(zfs, args):
+    'list one changed file per KB written since the snapshot'
+    names = [a for a in args if not a.startswith('-')]
+    d, i = zfs.find_snap(names[0])
+    mountpoint = d['mountpoint']
+    for i in range(d['written'] // 1024):
+        kind = '+-MR'[i % 4]
+        line = '%s\t%s/dir%d/file%d' % (kind, mountpoint, i % 3, i)
+        if kind == 'R':
+            line += '\t%s/dir%d/moved%d' % (mountpoint, i % 3, i)
+        print line
+
+def cmd_send(zfs, args):
+    '''write stream of a JSON header listing the snapshots sent, then one
+    byte per byte of snapshot size'''
+    parser = argparse.ArgumentParser(prog='zfs send')
+    for flag in 'nvPcLew':
+        parser.add_argument('-' + flag, action='store_true')
+    parser.add_argument('-i')
+    parser.add_argument('-I')
+    parser.add_argument('-t')
+    parser.add_argument('snap', nargs='?')
+    args = parser.parse_args(args)
+    flags = [flag for flag in 'cLew' if getattr(args, flag)]
+    if args.t: # resume token
+        token = json.loads(args.t.decode('hex'))
+        if args.n:
+            print 'resume token contents:\nnvlist version: 0'
+            print '\ttoguid = 0x%x' % int(token['toguid'])
+            print '\ttoname = %s' % token['toname']
+            if args.P:
+                print 'full\t%s\t%d\nsize\t%d' % (token['toname'], token['remaining'],
+                                                  token['remaining'])
+            return
+        header = dict(token['header'], resumed=True)
+        sys.stdout.write(json.dumps(header) + '\n' + 'x' * token['remaining'])
+        return
+    d, j = zfs.find_snap(args.snap)
+    fs = args.snap.split('@')[0]
+    fromsnap = args.i or args.I
+    base = None
+    snaps = [d['snaps'][j]]
+    if fromsnap:
+        d, k = zfs.find_snap(fs + '@' + fromsnap.split('@')[-1])
+        base = d['snaps'][k]['guid']
+        if args.I:
+            snaps = d['snaps'][k + 1:j + 1]
+    size = sum([s['size'] for s in snaps]) + 100 * len(snaps)
+    if args.n:
+        if fromsnap:
+            print 'incremental\t%s\t%s\t%d' % (fromsnap, args.snap, size)
+        else:
+            print 'full\t%s\t%d' % (args.snap, size)
+        print 'size\t%d' % size
+        return
+    sys.stdout.write(json.dumps(dict(base=base, snaps=snaps, flags=flags, src=fs)) + '\n')
+    chunk = 'x' * 65536
+    while size > 0:
+        sys.stdout.write(chunk[:size])
+        size -= len(chunk)
+
+def cmd_receive(zfs, args):
+    '''receive a stream from cmd_send().  If FAKEZFS_FAIL_RECV names the
+    destination, fail, leaving a resume token if -s'''
+    dest = args[-1]
+    if '-A' in args:
+        d = zfs.edit(dest)
+        d.pop('token', None)
+        if not d['snaps']:
+            zfs.delete(dest)
+        zfs.save()
+        return
+    header = json.loads(sys.stdin.readline())
+    sys.stdin.read()
+    zfs.lock() # only now, so the sender can run meanwhile
+    zfs.load()
+    d = zfs.get(dest)
+    if d is None:
+        if header['base'] and not header.get('resumed'):
+            die("cannot receive incremental stream: destination '%s' does not exist" % dest)
+        if '/' in dest and not zfs.exists(dest.rsplit('/', 1)[0]):
+            die("cannot receive new filesystem stream: parent of '%s' does not exist" % dest)
+        d = zfs.create(dest)
+    else:
+        d = zfs.edit(dest)
+    if d.get('token') and not header.get('resumed'):
+        die("destination %s contains partially-complete state from \"zfs receive -s\"." % dest)
+    if header['base'] and not header.get('resumed') and \
+       (not d['snaps'] or d['snaps'][-1]['guid'] != header['base']):
+        die("cannot receive incremental stream: most recent snapshot of %s does not match incremental source" % dest)
+    if os.environ.get('FAKEZFS_FAIL_RECV') == dest:
+        if '-s' in args:
+            last = header['snaps'][-1]
+            token = dict(toguid=last['guid'], toname=header['src'] + '@' + last['name'],
+                         header=header, remaining=10)
+            d['token'] = json.dumps(token).encode('hex')
+            zfs.save()
+        die('cannot receive: checksum mismatch or incomplete stream')
+    names = set([s['name'] for s in d['snaps']])
+    for s in header['snaps']:
+        if s['name'] in names:
+            die('cannot restore to %s@%s: destination already exists' % (dest, s['name']))
+    d.pop('token', None)
+    for s in header['snaps']: # each received snapshot is committed in its own txg
+        d['snaps'].append(dict(s, createtxg=zfs.next_txg()))
+    zfs.save()
+
+def run_zpool(zfs, args):
+    zfs.load()
+    if args[0] == 'list':
+        for pool in zfs.names():
+            if '/' not in pool:
+                print pool
+    elif args[0] == 'get':
+        features = zfs.state.get('features', {}).get(args[-1], {})
+        for feature in FEATURES:
+            print 'feature@%s\t%s' % (feature, features.get(feature, 'active'))
+    else:
+        die('fakezfs: unsupported zpool command %s' % args[0])
+
+def run_zfs(zfs, args):
+    try:
+        func = dict(list=cmd_list, get=cmd_get, snapshot=cmd_snapshot,
+                    destroy=cmd_destroy, create=cmd_create, set=cmd_set,
+                    rollback=cmd_rollback, diff=cmd_diff, send=cmd_send,
+                    receive=cmd_receive, recv=cmd_receive)[args[0]]
+    except KeyError:
+        die('fakezfs: unsupported zfs command %s' % args[0])
+    if func in (cmd_snapshot, cmd_destroy, cmd_create, cmd_set, cmd_rollback) \
+       or (func is cmd_receive and '-A' in args):
+        zfs.lock()
+    zfs.load()
+    func(zfs, args[1:])
+
+
+def get_init_args(args):
+    parser = argparse.ArgumentParser(prog='fakezfs.py init')
+    parser.add_argument('state', help='path of state file to create')
+    parser.add_argument('--pools', type=int, default=2)
+    parser.add_argument('--filesystems', type=int, default=10)
+    parser.add_argument('--snapshots', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mount-root', default='',
+                        help='directory under which datasets appear mounted')
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'zfs':
+        run_zfs(ZfsModel(), sys.argv[2:])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'zpool':
+        run_zpool(ZfsModel(), sys.argv[2:])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'init':
+        args = get_init_args(sys.argv[2:])
+        init_state(args.state, args.pools, args.filesystems, args.snapshots,
+                   args.seed, args.mount_root)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'install':
+        install(sys.argv[2])
+    else:
+        print __doc__
+        sys.exit(1)
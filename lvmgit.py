@@ -1,7 +1,14 @@
 import zgit
-import subprocess
 import os
 import argparse
+import subprocess
+import hashlib
+import json
+import re
+import time
+
+CHUNK_SIZE = 4 * 1024 * 1024 # bytes compared per checksum in block mode
+MANIFESTDIR = '~/.lvmgit' # checksum manifests of zvols imported in block mode
 
 def add_lv(configDict, lvPath, zfsName, mountDict=None, autoCreate=True):
     'add the specified mapping lvPath --> zfsName, creating ZFS fs if requested'
@@ -25,10 +32,33 @@ def create_lvm_snapshot(lvPath, snap=None, snapSize=None,
         cmd[2] = snapSize
     if snap is None:
         snap = zgit.datesnap_name()
-    subprocess.check_call(cmd + [snap, lvPath]) # take the LVM snapshot
+    zgit.check_call(cmd + [snap, lvPath]) # take the LVM snapshot
     lvSnapPath = os.path.join(os.path.dirname(lvPath), snap)
     return lvSnapPath
 
+def get_lvm_snapshot_name(lvPath, snap):
+    'get name for LVM snapshot snap of lvPath, unique within its volume group'
+    return '%s-%s' % (os.path.basename(lvPath), snap)
+
+def get_volume_group(lvPath):
+    'get volume group name of /dev/VG/LV or /dev/mapper/VG-LV'
+    if os.path.dirname(lvPath) == '/dev/mapper': # "-" in names is doubled
+        return re.split(r'(?<!-)-(?!-)', os.path.basename(lvPath))[0].replace('--', '-')
+    return os.path.basename(os.path.dirname(lvPath))
+
+def record_snapshot_time(lvPath, start, kept=False):
+    'record how long the LVM snapshot of lvPath was held open (since start)'
+    zgit.add_trace(['lvm-snapshot', lvPath], start, 0, kept=kept)
+
+def print_snapshot_times(records):
+    'print how long each LVM snapshot was held open, from trace records'
+    records = [r for r in records if r['kind'] == 'lvm-snapshot']
+    if records:
+        print 'LVM snapshots held open:'
+    for r in sorted(records, key=lambda r:-r['seconds']):
+        print '%8.1f sec  %s%s' % (r['seconds'], r['cmd'].split(' ', 1)[1],
+                                   r['kept'] and ' (still open)' or '')
+
 def cp_snapshot_to_zfs(lvSnapPath, zfsPath, zfsName, snap=None, mountDir='/root/zgit',
                        mountCmd=['mount', '-o', 'ro'],
                        rsyncCmd=['rsync', '-a', '--delete'], **kwargs):
@@ -36,35 +66,224 @@ def cp_snapshot_to_zfs(lvSnapPath, zfsPath, zfsName, snap=None, mountDir='/root/
     if snap is None:
         snap = os.path.basename(lvSnapPath)
     ensure_dir_exists(mountDir)
-    mountPoint = os.path.join(mountDir, snap)
+    mountPoint = os.path.join(mountDir, os.path.basename(lvSnapPath))
     ensure_dir_exists(mountPoint)
-    subprocess.check_call(mountCmd + [lvSnapPath, mountPoint]) # mount it read-only
+    zgit.check_call(mountCmd + [lvSnapPath, mountPoint]) # mount it read-only
     print 'copying snapshot from %s --> %s' % (lvSnapPath, zfsName)
-    subprocess.check_call(rsyncCmd + [mountPoint + '/', zfsPath]) # rsync to ZFS
+    zgit.check_call(rsyncCmd + [mountPoint + '/', zfsPath]) # rsync to ZFS
     zfsSnap = zgit.create_snapshot(zfsName, snap, **kwargs)
-    subprocess.check_call(['umount', mountPoint]) # unmount LVM snapshot
+    zgit.check_call(['umount', mountPoint]) # unmount LVM snapshot
     os.rmdir(mountPoint) # rm temporary snap mountpoint
     return zfsSnap
 
 def destroy_lvm_snapshot(lvSnapPath, destroyCmd=['lvremove', '-f']):
     'permanently delete this LVM snapshot'
-    subprocess.check_call(destroyCmd + [lvSnapPath])
+    zgit.check_call(destroyCmd + [lvSnapPath])
+
+#########################################################
+# block-level import
+
+def read_manifest(path):
+    '''get (header dict, list of chunk digests) of the previous block
+    import, or (None, []) if there is none'''
+    try:
+        with open(path, 'rb') as ifile:
+            header = json.loads(ifile.readline())
+            data = ifile.read()
+    except (IOError, ValueError):
+        return None, []
+    n = header['digestSize']
+    return header, [data[i:i + n] for i in range(0, len(data), n)]
+
+def write_manifest(path, header, digests):
+    'write header line and chunk digests of a block import'
+    with open(path + '.tmp', 'wb') as ofile:
+        ofile.write(json.dumps(header) + '\n')
+        ofile.write(''.join(digests))
+    os.rename(path + '.tmp', path)
+
+def get_size(path):
+    'get size in bytes of a file or block device'
+    with open(path, 'rb') as ifile:
+        ifile.seek(0, 2)
+        return ifile.tell()
+
+def import_blocks(srcPath, targetPath, manifestPath, chunkSize=CHUNK_SIZE,
+                  digests=None, changedChunks=None, **header):
+    '''copy srcPath (e.g. an LVM snapshot) to targetPath (an image file or
+    zvol), writing only chunks that differ from the previous import, as
+    recorded by its digests.  Without digests, compare with the chunks
+    already in targetPath instead.  If changedChunks (set of chunk indexes)
+    is given, assume all other chunks are unchanged and skip reading them.
+    Save new digests (and header fields) to manifestPath.
+    Return (chunks read, bytes written)'''
+    start = time.time()
+    size = get_size(srcPath)
+    if not os.path.exists(targetPath):
+        open(targetPath, 'wb').close()
+        digests = None # nothing imported yet
+    isFile = os.path.isfile(targetPath)
+    targetSize = get_size(targetPath)
+    if not isFile and targetSize < size:
+        raise ValueError('%s is smaller than %s' % (targetPath, srcPath))
+    nChunks = (size + chunkSize - 1) // chunkSize
+    if digests is None or changedChunks is None:
+        changedChunks = range(nChunks) # check them all
+    else: # also chunks beyond the previous import
+        changedChunks = sorted(set([i for i in changedChunks if i < nChunks])
+                               | set(range(len(digests), nChunks)))
+    newDigests = list(digests or [])[:nChunks]
+    newDigests += [None] * (nChunks - len(newDigests))
+    if os.path.exists(manifestPath): # invalid until this import completes
+        os.unlink(manifestPath)
+    nWritten = 0
+    with open(srcPath, 'rb') as src:
+        with open(targetPath, 'r+b') as target:
+            for i in changedChunks:
+                src.seek(i * chunkSize)
+                data = src.read(chunkSize)
+                digest = hashlib.sha256(data).digest()
+                if i * chunkSize >= targetSize: # past end of file, which reads as zeros
+                    changed = data.count('\0') < len(data)
+                elif digests is not None:
+                    changed = i >= len(digests) or digests[i] != digest
+                else:
+                    target.seek(i * chunkSize)
+                    changed = target.read(len(data)) != data
+                if changed:
+                    target.seek(i * chunkSize)
+                    target.write(data)
+                    nWritten += len(data)
+                newDigests[i] = digest
+            if isFile:
+                target.truncate(size)
+            target.flush()
+            os.fsync(target.fileno())
+    zgit.add_trace(['block-import', srcPath, targetPath], start, 0, bytes=nWritten)
+    header.update(chunkSize=chunkSize, size=size,
+                  digestSize=hashlib.sha256().digest_size)
+    write_manifest(manifestPath, header, newDigests)
+    return len(changedChunks), nWritten
+
+def get_thin_info(lvPath, cmd=['lvs', '--noheadings', '--separator', '/',
+                               '-o', 'vg_name,pool_lv,thin_id']):
+    'get (volume group, thin pool, thin device id) of lvPath, or None if not thin'
+    vg, pool, thinId = [s.strip() for s in zgit.check_output(cmd + [lvPath]).split('/')]
+    if not pool or not thinId:
+        return None
+    return vg, pool, int(thinId)
+
+def parse_thin_delta(xml):
+    '''get (data block size in 512 byte sectors, list of (begin, length)
+    block ranges that differ) from thin_delta output'''
+    blockSize = int(re.search(r'data_block_size="(\d+)"', xml).group(1))
+    ranges = [(int(begin), int(length)) for begin, length in
+              re.findall(r'<(?:different|left_only|right_only)\s+begin="(\d+)"\s+'
+                         r'length="(\d+)"', xml)]
+    return blockSize, ranges
+
+def get_changed_chunks(oldLvPath, newLvPath, chunkSize=CHUNK_SIZE,
+                       deltaCmd=['thin_delta', '-m'], messageCmd=['dmsetup', 'message']):
+    '''get set of indexes of the chunks that differ between thin snapshots
+    oldLvPath and newLvPath, from their thin pool's metadata, or None if
+    the metadata cannot tell'''
+    try:
+        old, new = get_thin_info(oldLvPath), get_thin_info(newLvPath)
+        if not old or not new or old[:2] != new[:2]:
+            return None
+        dmName = '-'.join([name.replace('-', '--') for name in new[:2]])
+        zgit.check_call(messageCmd + [dmName + '-tpool', '0', 'reserve_metadata_snap'])
+        try:
+            xml = zgit.check_output(deltaCmd + ['--thin1', str(old[2]), '--thin2', str(new[2]),
+                                                '/dev/mapper/%s_tmeta' % dmName])
+        finally:
+            zgit.check_call(messageCmd + [dmName + '-tpool', '0', 'release_metadata_snap'])
+    except (subprocess.CalledProcessError, OSError):
+        print 'WARNING: cannot read thin pool changes; checksumming all of %s' % newLvPath
+        return None
+    blockSize, ranges = parse_thin_delta(xml)
+    blockBytes = blockSize * 512
+    chunks = set()
+    for begin, length in ranges:
+        chunks.update(range(begin * blockBytes // chunkSize,
+                            ((begin + length) * blockBytes - 1) // chunkSize + 1))
+    return chunks
+
+def get_block_target(zfsPath, zfsName, image='lvm.img', manifestDir=MANIFESTDIR):
+    '''get (path to copy LVM snapshot to, path of its manifest): the zvol
+    zfsName if it is one, or else image file in its mountpoint zfsPath'''
+    if zfsPath == '-': # zvol, not mounted
+        manifestDir = os.path.expanduser(manifestDir)
+        ensure_dir_exists(manifestDir)
+        return ('/dev/zvol/' + zfsName,
+                os.path.join(manifestDir, zfsName.replace('/', '_') + '.manifest'))
+    return os.path.join(zfsPath, image), os.path.join(zfsPath, image + '.manifest')
+
+def block_commit(lvPath, zfsPath, zfsName, snap=None, commitMsg=None, snapSize=None,
+                 keepLvmSnap=False, chunkSize=CHUNK_SIZE, image='lvm.img',
+                 thinDelta=False, snapshotDict=None, **kwargs):
+    '''save snapshot of LVM logical volume to an image file or zvol in ZFS,
+    writing only the chunks that changed since the previous commit.
+    With thinDelta, keep the LVM snapshot until the next commit, which
+    reads only the chunks that the thin pool metadata says have changed'''
+    if snap is None:
+        snap = zgit.datesnap_name()
+    start = time.time()
+    if thinDelta: # thin snapshot: no size, and activated for reading
+        lvSnapPath = create_lvm_snapshot(lvPath, get_lvm_snapshot_name(lvPath, snap),
+                                         cmd=['lvcreate', '-s', '-kn', '-n'])
+    else:
+        lvSnapPath = create_lvm_snapshot(lvPath, get_lvm_snapshot_name(lvPath, snap),
+                                         snapSize)
+    targetPath, manifestPath = get_block_target(zfsPath, zfsName, image)
+    header, digests = read_manifest(manifestPath)
+    lastLvSnap = header and header.get('lvSnapshot')
+    if lastLvSnap and not os.path.exists(lastLvSnap):
+        lastLvSnap = None
+    if snapshotDict is None or zfsName not in snapshotDict:
+        snapshotDict = zgit.get_scoped_snapshot_dict([zfsName])
+    snaps = snapshotDict.get(zfsName)
+    if not header or header['chunkSize'] != chunkSize or not snaps \
+       or header.get('snapshot') != snaps.names[-1]: # rolled back, or never committed
+        header, digests = {}, None
+    changedChunks = None
+    if thinDelta and header and lastLvSnap:
+        changedChunks = get_changed_chunks(lastLvSnap, lvSnapPath, chunkSize)
+    print 'copying changed blocks from %s --> %s' % (lvSnapPath, targetPath)
+    nRead, nWritten = import_blocks(lvSnapPath, targetPath, manifestPath, chunkSize,
+                                    digests, changedChunks, snapshot=snap,
+                                    lvSnapshot=thinDelta and lvSnapPath or None)
+    print 'checked %d chunks, wrote %s' % (nRead, zgit.format_bytes(nWritten))
+    zfsSnap = zgit.create_snapshot(zfsName, snap, commitMsg=commitMsg,
+                                   snapshotDict=snapshotDict, **kwargs)
+    if lastLvSnap: # superseded by this one
+        destroy_lvm_snapshot(lastLvSnap)
+    kept = bool(thinDelta or keepLvmSnap or snapSize)
+    if not kept: # thinDelta keeps it for the next delta
+        destroy_lvm_snapshot(lvSnapPath)
+    record_snapshot_time(lvPath, start, kept)
+    return zfsSnap
 
 def commit(lvPath, zfsPath, zfsName, snap=None, commitMsg=None, snapSize=None,
            keepLvmSnap=False, **kwargs):
     'save snapshot of LVM logical volume to ZFS'
     if snapSize: # user passed explicit reservation
         keepLvmSnap = True
-    lvSnapPath = create_lvm_snapshot(lvPath, snap, snapSize)
+    if snap is None:
+        snap = zgit.datesnap_name()
+    start = time.time()
+    lvSnapPath = create_lvm_snapshot(lvPath, get_lvm_snapshot_name(lvPath, snap), snapSize)
     zfsSnap = cp_snapshot_to_zfs(lvSnapPath, zfsPath, zfsName, snap,
                                  commitMsg=commitMsg, **kwargs)
     if not keepLvmSnap: # delete LVM snapshot
         destroy_lvm_snapshot(lvSnapPath)
+    record_snapshot_time(lvPath, start, keepLvmSnap)
     return zfsSnap
 
 def do_commit(lvPath, zfsName=None, configDict=None, snap=None, commitMsg=None,
-              mountDict=None, **kwargs):
-    'save snapshot of LVM logical volume to associated ZFS'
+              mountDict=None, blockOpts=None, **kwargs):
+    '''save snapshot of LVM logical volume to associated ZFS, by rsync or
+    (if blockOpts dict or its config says so) by block_commit()'''
     if not zfsName:
         if configDict is None:
             configDict = zgit.read_json_config()
@@ -75,9 +294,31 @@ def do_commit(lvPath, zfsName=None, configDict=None, snap=None, commitMsg=None,
     if mountDict is None:
         mountDict = zgit.get_mount_dict()
     zfsPath = mountDict[zfsName]
+    if blockOpts is None:
+        if configDict is None:
+            configDict = zgit.read_json_config()
+        blockOpts = configDict.get('lvmBlock', {}).get(lvPath)
+    if blockOpts is not None: # block-level import, as configured by lvmgit init --block
+        kwargs.update(blockOpts)
+        return block_commit(lvPath, zfsPath, zfsName, snap, commitMsg, **kwargs)
     return commit(lvPath, zfsPath, zfsName, snap, commitMsg, **kwargs)
 
     
+def queue_commits(scheduler, configDict, snapshotDict=None, vgJobs=2, mountDict=None):
+    '''queue commit of every LVM volume in configDict lvmMap on scheduler
+    (a zgit.TransferScheduler), at most vgJobs at once per volume group.
+    Return dict of {zfsName:job key} for syncs to wait for'''
+    lvmMap = configDict.get('lvmMap', {})
+    if lvmMap and mountDict is None:
+        mountDict = zgit.get_mount_dict()
+    waitFor = {}
+    for lvPath, zfsName in lvmMap.items(): # counted per volume group, not zpool
+        scheduler.add(lvPath, do_commit, (), lvPath, configDict=configDict,
+                      mountDict=mountDict, snapshotDict=snapshotDict)
+        scheduler.limit(lvPath, 'vg ' + get_volume_group(lvPath), vgJobs)
+        waitFor[zfsName] = lvPath
+    return waitFor
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('command', help='git-style command to run')
@@ -85,8 +326,25 @@ def get_args():
     parser.add_argument('--lvmpath', help='LVM logical volume path')
     parser.add_argument('--zfsname', help='ZFS filesystem name')
     parser.add_argument('--size', help='LVM snapshot reservation size')
+    parser.add_argument('--block', action='store_true',
+                        help='copy changed blocks to an image file (or zvol) instead of rsync')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE // (1024 * 1024),
+                        help='MB per checksummed chunk, for --block')
+    parser.add_argument('--image', default='lvm.img',
+                        help='name of image file in ZFS filesystem, for --block')
+    parser.add_argument('--thin-delta', action='store_true',
+                        help='for --block on thin LVs, read only blocks the thin pool says changed')
     return parser.parse_args()
 
+def get_block_opts(args):
+    'get block_commit() options from command line, or None if not --block'
+    if not args.block:
+        return None
+    opts = dict(chunkSize=args.chunk_size * 1024 * 1024, image=args.image)
+    if args.thin_delta:
+        opts['thinDelta'] = True
+    return opts
+
 def commit_cmd(args):
     configDict = zgit.read_json_config()
     commitMsg = args.message
@@ -109,7 +367,8 @@ def commit_cmd(args):
         except NameError:
             raise ValueError('%s not mapped to any LVM logical volume'
                              % zfsName)
-    do_commit(lvPath, zfsName, commitMsg=commitMsg, snapSize=args.size)
+    do_commit(lvPath, zfsName, configDict, commitMsg=commitMsg, snapSize=args.size,
+              blockOpts=get_block_opts(args))
 
 def init_cmd(args):
     'add a new LVM logical volume -> ZFS filesystem mapping'
@@ -117,11 +376,12 @@ def init_cmd(args):
     if not args.lvmpath or not args.zfsname:
         raise ValueError('--lvmpath and --zfsname required for init!')
     add_lv(configDict, args.lvmpath, args.zfsname)
-    zgit.do_init(args.zfsname, configDict['backupMap'])
-    zgit.write_json_config(configDict) # save new mapping
+    zgit.save_init(args.zfsname)
+    zgit.save_lv(args.lvmpath, args.zfsname, get_block_opts(args)) # save new mapping
     
 if __name__ == '__main__':
     args = get_args()
+    zgit.set_phase(args.command)
     if args.command == 'commit':
         commit_cmd(args)
     elif args.command == 'init':
@@ -129,4 +389,6 @@ if __name__ == '__main__':
     else:
         print '''Usage: lvmgit COMMAND [args] [options]
         where COMMAND is:
+              init: map --lvmpath to ZFS --zfsname (with --block for block-level commits)
               commit: commit a snapshot of this LVM file system'''
+    zgit.report_trace(args.command)
@@ -4,8 +4,42 @@ import os
 import argparse
 import json
 import sys
+import threading
+import Queue
+import pipes
+import sqlite3
+import array
+import time
+import contextlib
+import socket
+import copy
+import traceback
+import signal
+import fcntl
 
 MAPPATH = '~/.zgit_conf.json'
+CATALOGPATH = '~/.zgit_catalog.sqlite'
+CATALOG_VERSION = 1 # rebuild catalogs written with a different schema
+DAEMONPATH = '~/.zgit_daemon.sock' # Unix socket of zgit daemon
+DAEMON_POLL = 300 # seconds between daemon inventory refreshes
+READONLY_COMMANDS = ('status', 'log', 'map', 'diff') # run in zgit daemon, if running
+zfsListCalls = 0 # number of zfs list commands run by this process
+transferBytes = {} # bytes received by each ZFS filesystem in this process
+TRANSFER_BUFFER = 256 * 1024 * 1024 # bytes buffered between send and receive
+TRANSFER_CHUNK = 1024 * 1024
+TRANSFER_RATE = 100 * 1024 * 1024 # bytes/sec assumed per transfer in plan ETA
+SEND_FLAG_FEATURES = {'-c': 'feature@lz4_compress', # pool feature required
+                      '-e': 'feature@embedded_data', # to receive each
+                      '-L': 'feature@large_blocks', # zfs send flag
+                      '-w': 'feature@encryption'}
+poolFeatures = {} # cached zpool feature states
+transports = {} # Transport for each remote host, shared by the whole run
+inventoryLock = threading.Lock()
+transportLock = threading.Lock()
+warmInventory = None # WarmInventory, when running in zgit daemon
+traceRecords = [] # one dict per subprocess run by this process
+tracePhases = [] # (phase, start time) in order
+traceLock = threading.Lock()
 
 class ZfsReceiveError(ValueError):
     pass
@@ -17,31 +51,504 @@ def datesnap_name(dt=None, fmt='%y%m%d%H%M'):
         dt = datetime.datetime.now()
     return dt.strftime(fmt)
 
-def get_snapshot_dict(cmd=['zfs', 'list', '-H', '-t', 'snapshot', '-o',
-                           'name,guid,creation,org.zgit:commitmsg'],
-                      cmd1=['zfs', 'list', '-H', '-o', 'name']):
-    'get dict of file systems each with time-ordered list of snapshots'
+###############################################################
+# transports for running zfs commands on remote hosts
+
+class LocalTransport(object):
+    'run zfs commands on this host'
+    def wrap(self, cmd):
+        'get the command line that runs cmd via this transport'
+        return cmd
+
+    def close(self):
+        pass
+
+class CommandTransport(LocalTransport):
+    '''run zfs commands via a command prefix that executes its last argument
+    as a shell command line, e.g. ['sh', '-c'] standing in for a remote host'''
+    def __init__(self, prefix):
+        self.prefix = list(prefix)
+
+    def wrap(self, cmd):
+        return self.prefix + [' '.join([pipes.quote(arg) for arg in cmd])]
+
+class SshTransport(CommandTransport):
+    '''run zfs commands on host over ssh, multiplexing all inventory
+    queries and streams over one master connection'''
+    def __init__(self, host, sshCmd=('ssh',), controlDir='~/.zgit_ssh'):
+        controlDir = os.path.expanduser(controlDir)
+        if not os.path.isdir(controlDir):
+            os.mkdir(controlDir, 0700)
+        self.sshCmd = list(sshCmd) + ['-o', 'ControlPath=' +
+                                      os.path.join(controlDir, '%r@%h:%p')]
+        self.host = host
+        CommandTransport.__init__(self, self.sshCmd + [host])
+
+    def open(self):
+        'start the master connection, in the background'
+        check_call(self.sshCmd + ['-o', 'ControlMaster=auto',
+                                             '-o', 'ControlPersist=600',
+                                             '-f', '-N', self.host])
+
+    def close(self):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(self.sshCmd + ['-O', 'exit', self.host],
+                            stderr=devnull)
+
+def split_host(name):
+    'split "host:pool/fs" into (host, "pool/fs"); host is None if local'
+    if ':' in name.split('/')[0]:
+        return tuple(name.split(':', 1))
+    return None, name
+
+def get_hosts(names):
+    'get set of remote hosts in list of ZFS names'
+    return set([split_host(name)[0] for name in names]) - set([None])
+
+def get_map_names(backupMap):
+    'get list of all source and destination ZFS names in backupMap'
+    names = list(backupMap)
+    for dests in backupMap.values():
+        names += [t[1] for t in dests]
+    return names
+
+def get_map_hosts(backupMap):
+    'get set of remote hosts used in backupMap'
+    return get_hosts(get_map_names(backupMap))
+
+def make_transport(host, transportConf):
+    'create transport for host from its config dict, if any'
+    kind = transportConf.get('type', 'ssh')
+    if kind == 'local':
+        return LocalTransport()
+    elif kind == 'command':
+        return CommandTransport(transportConf['command'])
+    elif kind == 'ssh':
+        t = SshTransport(transportConf.get('host', host),
+                         transportConf.get('command', ('ssh',)))
+        t.open()
+        return t
+    raise ValueError('unknown transport type %s for %s' % (kind, host))
+
+def get_transport(host):
+    'get the shared transport for host, as configured in MAPPATH transports'
+    with transportLock:
+        try:
+            return transports[host]
+        except KeyError:
+            transportConf = read_json_config().get('transports', {}).get(host, {})
+            t = transports[host] = make_transport(host, transportConf)
+            return t
+
+def close_transports():
+    'close all transport connections opened by this run'
+    for t in transports.values():
+        t.close()
+    transports.clear()
+
+def host_cmd(host, cmd):
+    'get command line that runs cmd on host (this host if None)'
+    if host is None:
+        return cmd
+    return get_transport(host).wrap(cmd)
+
+def zfs_cmd(cmd, name, *args):
+    '''get command line that runs cmd on the host of ZFS name,
+    with the name (stripped of its host prefix) and args appended'''
+    host, name = split_host(name)
+    return host_cmd(host, cmd + [name] + list(args))
+
+###############################################################
+# tracing of subprocesses, with timing summary and metrics files
+
+def set_phase(phase):
+    'start a new phase of this run, to which subsequent commands are charged'
+    tracePhases.append((phase, time.time()))
+
+def get_command_kind(cmd):
+    'get short name of cmd for grouping, e.g. "zfs send" even via ssh'
+    words = ' '.join(cmd).split()
+    for i, word in enumerate(words[:-1]):
+        if os.path.basename(word) in ('zfs', 'zpool'):
+            return os.path.basename(word) + ' ' + words[i + 1]
+    return os.path.basename(words[0])
+
+def add_trace(cmd, start, status, **fields):
+    'record that cmd ran from start until now, exiting with status'
+    record = dict(cmd=' '.join(cmd), kind=get_command_kind(cmd), start=start,
+                  seconds=time.time() - start, status=status,
+                  phase=tracePhases and tracePhases[-1][0] or None)
+    record.update(fields)
+    with traceLock:
+        traceRecords.append(record)
+
+@contextlib.contextmanager
+def trace(cmd, **fields):
+    'trace cmd run within this context'
+    start = time.time()
+    try:
+        yield
+    except subprocess.CalledProcessError as e:
+        add_trace(cmd, start, e.returncode, **fields)
+        raise
+    except OSError: # could not run it at all
+        add_trace(cmd, start, None, **fields)
+        raise
+    add_trace(cmd, start, 0, **fields)
+
+def check_call(cmd, **kwargs):
+    'traced subprocess.check_call()'
+    with trace(cmd):
+        return subprocess.check_call(cmd, **kwargs)
+
+def check_output(cmd, **kwargs):
+    'traced subprocess.check_output()'
+    with trace(cmd):
+        return subprocess.check_output(cmd, **kwargs)
+
+def summarize_trace(records):
+    '''get list of (phase, kind, count, failures, seconds, bytes), grouped
+    by phase, in order of first use'''
     d = {}
-    for name in subprocess.check_output(cmd1).split('\n')[:-1]:
-        d[name] = [] # create empty entry for each ZFS filesystem
-    for s in subprocess.check_output(cmd).split('\n')[:-1]:
-        name, guid, creation, commitMsg = s.split('\t')
+    phaseOrder = {}
+    for r in records:
+        t = d.setdefault((r['phase'], r['kind']),
+                         [(phaseOrder.setdefault(r['phase'], len(phaseOrder)), len(d)),
+                          0, 0, 0., 0])
+        t[1] += 1
+        t[2] += r['status'] != 0
+        t[3] += r['seconds']
+        t[4] += r.get('bytes', 0)
+    return [k + tuple(t[1:]) for k, t in sorted(d.items(), key=lambda x:x[1][0])]
+
+def print_trace_summary(ofile=None):
+    'print time spent in each phase, and in each kind of command within it'
+    if not traceRecords:
+        return
+    if ofile is None:
+        ofile = sys.stderr
+    ends = [t[1] for t in tracePhases[1:]] + [time.time()]
+    phaseTimes = dict([(t[0], 0.) for t in tracePhases])
+    for (phase, start), end in zip(tracePhases, ends): # phases may repeat
+        phaseTimes[phase] += end - start
+    lastPhase = ()
+    for phase, kind, count, failures, seconds, nbytes in summarize_trace(traceRecords):
+        if phase != lastPhase:
+            print >>ofile, '%s: %.1f sec' % (phase, phaseTimes.get(phase, 0.))
+            lastPhase = phase
+        print >>ofile, '  %-14s %4d calls %8.1f sec%s%s' % (kind, count, seconds,
+            nbytes and ' %10s (%s/sec)' % (format_bytes(nbytes),
+                                            format_bytes(nbytes / max(seconds, 1e-6)))
+            or '', failures and ' %d FAILED' % failures or '')
+
+def write_trace_json(path, command):
+    'append the trace of this run to path as JSON lines'
+    with open(os.path.expanduser(path), 'a') as ofile:
+        for record in traceRecords:
+            record = dict(record, command=command)
+            ofile.write(json.dumps(record, sort_keys=True) + '\n')
+
+def prometheus_labels(**labels):
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                            .replace('"', '\\"'))
+                              for k, v in sorted(labels.items())])
+
+def write_trace_prometheus(path, command):
+    '''write metrics of this run to path in Prometheus text format (e.g. for
+    node_exporter's textfile collector), replacing it atomically'''
+    lines = ['# TYPE zgit_last_run_timestamp_seconds gauge',
+             'zgit_last_run_timestamp_seconds%s %d' % (prometheus_labels(command=command),
+                                                       time.time())]
+    summary = summarize_trace(traceRecords)
+    for name, column, kind in (('commands', 2, 'count'), ('command_failures', 3, 'count'),
+                               ('command_seconds', 4, 'sum'), ('command_bytes', 5, 'sum')):
+        lines.append('# TYPE zgit_%s gauge' % name)
+        for t in summary:
+            lines.append('zgit_%s%s %s' % (name, prometheus_labels(
+                command=command, phase=t[0], kind=t[1]), t[column]))
+    transfers = {} # total bytes and seconds of each src --> dest
+    for r in traceRecords:
+        if r['kind'] == 'zfs receive' and 'dest' in r:
+            t = transfers.setdefault((r['src'], r['dest']), [0, 0.])
+            t[0] += r['bytes']
+            t[1] += r['seconds']
+    for name, column in (('transfer_bytes', 0), ('transfer_seconds', 1)):
+        lines.append('# TYPE zgit_%s gauge' % name)
+        for (src, dest), t in sorted(transfers.items()):
+            lines.append('zgit_%s%s %s' % (name, prometheus_labels(
+                command=command, src=src, dest=dest), t[column]))
+    path = os.path.expanduser(path)
+    with open(path + '.tmp', 'w') as ofile:
+        ofile.write('\n'.join(lines) + '\n')
+    os.rename(path + '.tmp', path)
+
+def report_trace(command, configDict=None):
+    '''print trace summary, and write metrics files as configured in
+    MAPPATH "metrics": {"summary": true, "jsonLines": PATH, "prometheus": PATH}'''
+    if configDict is None:
+        configDict = read_json_config()
+    metrics = configDict.get('metrics', {})
+    if metrics.get('summary', True):
+        print_trace_summary()
+    if metrics.get('jsonLines'):
+        write_trace_json(metrics['jsonLines'], command)
+    if metrics.get('prometheus'):
+        write_trace_prometheus(metrics['prometheus'], command)
+
+
+def zfs_list(cmd):
+    'run a zfs list command and return its output, counting zfs list calls'
+    global zfsListCalls
+    zfsListCalls += 1
+    return check_output(cmd)
+
+def iter_zfs_list(cmd, allowMissing=False):
+    '''run a zfs list command and yield its output lines as they arrive,
+    so the full output is never held in memory.  If allowMissing, named
+    datasets that do not exist are silently left out'''
+    global zfsListCalls
+    zfsListCalls += 1
+    return iter_zfs_lines(cmd, allowMissing)
+
+def iter_zfs_lines(cmd, allowMissing=False):
+    'run a zfs command and yield its output lines, as for iter_zfs_list()'
+    start = time.time()
+    fields = {}
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=allowMissing and devnull or None)
+        try:
+            for line in p.stdout:
+                yield line[:-1]
+        except GeneratorExit: # reader stopped early, so stop zfs too
+            p.terminate()
+            fields['stopped'] = True # on purpose, so not a failure
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
+            add_trace(cmd, start, not fields and not (allowMissing and p.returncode == 1)
+                      and p.returncode or 0, **fields)
+    if p.returncode and not (allowMissing and p.returncode == 1):
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+class SnapshotInventory(dict):
+    '''dict of ZFS filesystems each with time-ordered list of snapshots.
+    resumeTokens holds the receive_resume_token of any filesystem that
+    has an interrupted zfs receive -s waiting to be resumed'''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.resumeTokens = {}
+        self.offline = set() # filesystems known only from the catalog
+
+    def __setitem__(self, fs, snaps):
+        if not isinstance(snaps, SnapshotList):
+            snaps = SnapshotList(snaps)
+        dict.__setitem__(self, intern_str(fs), snaps)
+
+    def setdefault(self, fs, snaps=()):
+        try:
+            return self[fs]
+        except KeyError:
+            self[fs] = snaps
+            return self[fs]
+
+def intern_str(s):
+    'intern s if it is a plain string, so repeated names share memory'
+    if type(s) is str:
+        return intern(s)
+    return s
+
+class SnapshotList(object):
+    '''time-ordered snapshots of one filesystem, stored column-wise: GUIDs
+    as 64-bit integers and creation times and txgs in typed arrays, names
+    and commit messages interned.  snaps[i] still gives the tuple
+    (snap, guid, creation, commitMsg), and find() and find_guid() look up
+    a snapshot by name or GUID in constant time'''
+    def __init__(self, snaps=()):
+        self.names = []
+        self.guids = array.array('L')
+        self.creations = array.array('l')
+        self.txgs = array.array('l') # createtxg, or 0 if not yet known
+        self.commitMsgs = []
+        self.index = None # ({name:i}, {guid:i}), built on first lookup
+        for t in snaps:
+            self.append(t)
+
+    def append(self, t, txg=0):
+        'add snapshot tuple t = (snap, guid, creation, commitMsg) at the end'
+        snap, guid, creation, commitMsg = t
+        if self.index is not None:
+            self.index[0][snap] = self.index[1][int(guid)] = len(self.names)
+        self.names.append(intern_str(snap))
+        self.guids.append(int(guid))
+        self.creations.append(creation)
+        self.txgs.append(txg)
+        self.commitMsgs.append(commitMsg and intern_str(commitMsg))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self.names)))]
+        return (self.names[i], str(self.guids[i]), self.creations[i],
+                self.commitMsgs[i])
+
+    def __iter__(self):
+        for i in xrange(len(self.names)):
+            yield self[i]
+
+    def __delitem__(self, i):
+        for column in (self.names, self.guids, self.creations, self.txgs,
+                       self.commitMsgs):
+            del column[i]
+        self.index = None
+
+    def discard(self, snaps):
+        'remove all snapshots whose names are in the set snaps'
+        keep = [i for i, snap in enumerate(self.names) if snap not in snaps]
+        for name in ('names', 'guids', 'creations', 'txgs', 'commitMsgs'):
+            column = getattr(self, name)
+            kept = [column[i] for i in keep]
+            if isinstance(column, array.array):
+                kept = array.array(column.typecode, kept)
+            setattr(self, name, kept)
+        self.index = None
+
+    def __repr__(self):
+        return 'SnapshotList(%r)' % list(self)
+
+    def get_index(self):
+        'get ({name:i}, {guid:i}) lookup dicts'
+        if self.index is None:
+            self.index = (dict([(snap, i) for i, snap in enumerate(self.names)]),
+                          dict([(guid, i) for i, guid in enumerate(self.guids)]))
+        return self.index
+
+    def find(self, snap):
+        'get index of the snapshot named snap, or raise KeyError'
+        return self.get_index()[0][snap]
+
+    def find_guid(self, guid):
+        'get index of the snapshot with GUID guid, or raise KeyError'
+        return self.get_index()[1][int(guid)]
+
+    def sort_by_txg(self):
+        'put snapshots in createtxg order, if they are not already'
+        a = self.txgs
+        if not any(a[i] > a[i + 1] for i in xrange(len(a) - 1)):
+            return
+        order = sorted(xrange(len(a)), key=a.__getitem__)
+        for name in ('names', 'guids', 'creations', 'txgs', 'commitMsgs'):
+            column = getattr(self, name)
+            reordered = [column[i] for i in order]
+            if isinstance(column, array.array):
+                reordered = array.array(column.typecode, reordered)
+            setattr(self, name, reordered)
+        self.index = None
+
+def get_snapshot_dict(cmd=['zfs', 'list', '-H', '-p', '-t', 'filesystem,volume,snapshot',
+                           '-o', 'name,guid,creation,createtxg,org.zgit:commitmsg,'
+                           'receive_resume_token'],
+                      hosts=(), catalog=None):
+    '''get dict of file systems each with time-ordered list of snapshots,
+    on this host and remote hosts (whose names get a "host:" prefix).
+    If catalog is given, refresh it and read the snapshots from it'''
+    if catalog is None and warmInventory and warmInventory.covers(hosts):
+        return warmInventory.snapshotDict
+    if catalog is not None:
+        for host in [None] + list(hosts):
+            catalog.refresh(host)
+        return catalog.get_inventory(hosts)
+    d = SnapshotInventory()
+    read_snapshot_list(cmd, d)
+    for host in hosts:
+        try:
+            read_snapshot_list(cmd, d, host)
+        except (subprocess.CalledProcessError, OSError):
+            print 'WARNING: cannot list ZFS filesystems on %s; skipping it' % host
+    return d
+
+def read_snapshot_list(cmd, d, host=None, wanted=None):
+    '''add filesystems and snapshots listed by cmd (zfs list -H -p) on host
+    to inventory d, each filesystem's snapshots sorted by createtxg.
+    If wanted is given, add only filesystems in that set'''
+    prefix = host and host + ':' or ''
+    for s in iter_zfs_list(host_cmd(host, cmd), wanted is not None):
+        name, guid, creation, txg, commitMsg, token = s.split('\t')
+        name = prefix + name
+        if '@' not in name: # create empty entry for each ZFS filesystem
+            if wanted is not None and name not in wanted:
+                continue
+            d.setdefault(name, [])
+            if token != '-':
+                d.resumeTokens[name] = token
+            continue
         if commitMsg == '-':
             commitMsg = None
         fs, snap = name.split('@')
-        d[fs].append((snap, guid, creation, commitMsg))
+        if wanted is not None and fs not in wanted:
+            continue
+        d.setdefault(fs).append((snap, guid, int(creation), commitMsg), int(txg))
+    for snaps in d.values(): # zfs list order is not guaranteed
+        snaps.sort_by_txg()
+
+
+def get_ancestors(fs):
+    'get list of the parent filesystems of fs, starting from its pool'
+    parts = fs.split('/')
+    return ['/'.join(parts[:i]) for i in range(1, len(parts))]
+
+def get_scoped_snapshot_dict(names,
+        cmd=['zfs', 'list', '-H', '-p', '-d', '1', '-t', 'filesystem,volume,snapshot',
+             '-o', 'name,guid,creation,createtxg,org.zgit:commitmsg,receive_resume_token']):
+    '''get inventory of just the filesystems names and their parents,
+    using one zfs list per host.  Names that do not exist are left out.
+    In zgit daemon, get its warm inventory instead if it covers names'''
+    if warmInventory and warmInventory.covers(get_hosts(names)):
+        return warmInventory.snapshotDict
+    byHost = {}
+    for name in names:
+        host, fs = split_host(name)
+        byHost.setdefault(host, set()).update([fs] + get_ancestors(fs))
+    d = SnapshotInventory()
+    for host, datasets in byHost.items():
+        prefix = host and host + ':' or ''
+        try:
+            read_snapshot_list(cmd + sorted(datasets), d, host,
+                               set([prefix + fs for fs in datasets]))
+        except (subprocess.CalledProcessError, OSError):
+            print 'WARNING: cannot list ZFS filesystems on %s; skipping it' % host
     return d
 
+def refresh_snapshots(fs, snapshotDict=None,
+                      cmd=['zfs', 'list', '-H', '-p', '-t', 'snapshot', '-d', '1', '-o',
+                           'name,guid,creation,createtxg,org.zgit:commitmsg,'
+                           'receive_resume_token']):
+    'relist the snapshots of fs, updating its entry in snapshotDict'
+    host, name = split_host(fs)
+    d = SnapshotInventory()
+    read_snapshot_list(cmd + [name], d, host)
+    snaps = d.get(fs, SnapshotList())
+    if snapshotDict is not None:
+        snapshotDict[fs] = snaps
+    return snaps
+
+def get_snaps(snapshotDict, fs):
+    '''get the snapshots of fs as a SnapshotList, even from a plain
+    {fs:[(snap, guid, creation, commitMsg),...]} dict'''
+    snaps = snapshotDict[fs]
+    if not isinstance(snaps, SnapshotList): # convert in place, so changes stick
+        snaps = snapshotDict[fs] = SnapshotList(snaps)
+    return snaps
 
 def find_snapshot(fs, snap, snapshotDict=None):
     'return index of snap in time-ordered list of snapshots for fs'
     if not snapshotDict:
-        snapshotDict = get_snapshot_dict()
-    snaps = snapshotDict[fs]
-    for i, t in enumerate(snaps):
-        if t[0] == snap:
-            return i, snaps
-    raise KeyError
+        snapshotDict = get_scoped_snapshot_dict([fs])
+    snaps = get_snaps(snapshotDict, fs)
+    return snaps.find(snap), snaps
 
 def zfs_send_cmd(zfs, snap, rootcommit=False, snapshotDict=None):
     'get fromsnap, cmd for zfs send zfs@snap'
@@ -96,58 +603,422 @@ def get_snapshot_map(snapshotDict, backupMap, sourceOrder=()):
         for src in otherSrcs:
             snapshotMap.setdefault((refSrc, src), []).append(guid)
     return snapshotMap
+
+class SnapshotLineage(object):
+    '''shared history of all filesystems in an inventory.  GUIDs are
+    interned to integers, and each filesystem's snapshots stored as an
+    array of GUID ids, so that the filesystem pairs, their shared commit
+    counts and ahead/behind counts all come from one pass over the
+    inventory instead of one pass per GUID or per pair'''
+    def __init__(self, snapshotDict):
+        self.names = sorted(snapshotDict)
+        self.guids = [] # GUID string for each GUID id
+        self.occurrences = [] # {fs index:snapshot position} for each GUID id
+        self.snaps = [] # array of GUID ids for each filesystem, time-ordered
+        guidIds = {}
+        for k, fs in enumerate(self.names):
+            a = array.array('l')
+            snaps = snapshotDict[fs]
+            if isinstance(snaps, SnapshotList):
+                guids = snaps.guids
+            else:
+                guids = [t[1] for t in snaps]
+            for pos, guid in enumerate(guids):
+                try:
+                    g = guidIds[guid]
+                except KeyError:
+                    g = guidIds[guid] = len(self.guids)
+                    self.guids.append(guid)
+                    self.occurrences.append({})
+                self.occurrences[g][k] = pos
+                a.append(g)
+            self.snaps.append(a)
+        self.fsIndex = dict([(fs, k) for k, fs in enumerate(self.names)])
+
+    def get_pairs(self, backupMap, sourceOrder=()):
+        '''get {(refSrc, src):shared GUID ids} exactly as get_snapshot_map
+        pairs filesystems, ranking each filesystem once rather than per GUID'''
+        rank = [0] * len(self.names)
+        for i, fs in enumerate(sort_sources(self.names, sourceOrder)):
+            k = self.fsIndex[fs]
+            rank[k] = i + (fs not in backupMap and len(rank) or 0) # registered first
+        pairs = {}
+        for g, occ in enumerate(self.occurrences):
+            if len(occ) < 2:
+                continue
+            ref = min(occ, key=rank.__getitem__)
+            for k in occ:
+                if k != ref:
+                    try:
+                        pairs[(ref, k)].append(g)
+                    except KeyError:
+                        pairs[(ref, k)] = array.array('l', (g,))
+        return dict([((self.names[a], self.names[b]), guids)
+                     for (a, b), guids in pairs.items()])
+
+    def count_divergences(self, src, dest):
+        'return #commits in src vs. dest after their last shared commit'
+        try:
+            a, b = self.fsIndex[src], self.fsIndex[dest]
+        except KeyError:
+            return None, None
+        srcSnaps = self.snaps[a]
+        for i in range(len(srcSnaps) - 1, -1, -1): # find last common snapshot
+            j = self.occurrences[srcSnaps[i]].get(b)
+            if j is not None:
+                return len(srcSnaps) - i - 1, len(self.snaps[b]) - j - 1
+        return None, None
+
+    def get_snapshot_map(self, backupMap, sourceOrder=()):
+        'get_snapshot_map() result, with GUID strings'
+        return dict([(pair, [str(self.guids[g]) for g in guids]) for pair, guids
+                     in self.get_pairs(backupMap, sourceOrder).items()])
         
 
 def get_mount_dict(cmd=['zfs', 'list', '-H', '-o', 'name,mountpoint']):
-    'get dict of file systems each with mount point'
+    'get dict of file systems each with mount point (from zgit daemon if running in it)'
+    if warmInventory and warmInventory.mountDict is not None:
+        return warmInventory.mountDict
     d = {}
-    for name in subprocess.check_output(cmd).split('\n')[:-1]:
+    for name in zfs_list(cmd).split('\n')[:-1]:
         fs, mountpoint = name.split('\t')
         d[fs] = mountpoint
     return d
 
-def create_snapshot(fs, snap=None, commitMsg=None, cmd=['zfs', 'snapshot']):
+def create_snapshot(fs, snap=None, commitMsg=None, cmd=['zfs', 'snapshot'],
+                    snapshotDict=None):
     'create the snapshot fs@snap and return its full name'
+    return create_snapshots([fs], snap, commitMsg, cmd, snapshotDict)[0]
+
+def create_snapshots(filesystems, snap=None, commitMsg=None, cmd=['zfs', 'snapshot'],
+                     snapshotDict=None):
+    '''create snapshot snap of all filesystems with one zfs snapshot call
+    per pool, so those on the same pool are taken atomically.
+    Return list of their full names'''
     if snap is None:
         snap = datesnap_name()
-    name = fs + '@' + snap
     if commitMsg:
         cmd = cmd + ['-o', 'org.zgit:commitmsg=%s' % commitMsg]
-    subprocess.check_call(cmd + [name])
-    return name
-
-def destroy_snapshot(fs, snap, cmd=['zfs', 'destroy']):
+    byPool = {}
+    for fs in filesystems:
+        byPool.setdefault(zfs_pool(fs), []).append(fs + '@' + snap)
+    created = []
+    try:
+        for pool, names in sorted(byPool.items()):
+            host = split_host(pool)[0]
+            check_call(host_cmd(host, cmd + [split_host(name)[1]
+                                                        for name in names]))
+            created += names
+    finally:
+        if snapshotDict is not None and created: # register new snapshots
+            register_snapshots(created, commitMsg, snapshotDict)
+    return created
+
+def register_snapshots(names, commitMsg, snapshotDict,
+                       cmd=['zfs', 'get', '-H', '-p', '-o', 'name,property,value',
+                            'guid,creation,createtxg']):
+    '''add the newly created snapshots names to snapshotDict in one step,
+    getting their properties with one zfs get per host'''
+    byHost = {}
+    for name in names:
+        host, name = split_host(name)
+        byHost.setdefault(host, []).append(name)
+    props = {}
+    for host, hostNames in byHost.items():
+        prefix = host and host + ':' or ''
+        for line in iter_zfs_lines(host_cmd(host, cmd + hostNames)):
+            name, prop, value = line.split('\t')
+            props.setdefault(prefix + name, {})[prop] = value
+    with inventoryLock:
+        for name in names:
+            fs, snap = name.split('@')
+            d = props[name]
+            snapshotDict.setdefault(fs).append((snap, d['guid'], int(d['creation']),
+                                                commitMsg or None),
+                                               int(d['createtxg']))
+
+def destroy_snapshot(fs, snap, cmd=['zfs', 'destroy'], snapshotDict=None):
     'destroy the snapshot fs@snap'
     name = fs + '@' + snap
-    subprocess.check_call(cmd + [name])
+    check_call(zfs_cmd(cmd, name))
+    if snapshotDict is not None: # unregister destroyed snapshot
+        i, snaps = find_snapshot(fs, snap, snapshotDict)
+        del snaps[i]
+
+def get_destroy_specs(fs, snaps, snapshotDict, batchSize=100):
+    '''get list of fs@a%b,c,... arguments for zfs destroy that together
+    destroy exactly snaps, as ranges of consecutive snapshots of fs.
+    Each argument holds at most batchSize ranges'''
+    doomed = set(snaps)
+    runs = [] # [first, last] of each run of consecutive doomed snapshots
+    inRun = False
+    for snap in get_snaps(snapshotDict, fs).names:
+        if snap in doomed:
+            if inRun:
+                runs[-1][1] = snap
+            else:
+                runs.append([snap, snap])
+            inRun = True
+        else:
+            inRun = False
+    parts = [a == b and a or '%s%%%s' % (a, b) for a, b in runs]
+    return ['%s@%s' % (split_host(fs)[1], ','.join(parts[i:i + batchSize]))
+            for i in range(0, len(parts), batchSize)]
+
+def destroy_snapshots(fs, snaps, cmd=['zfs', 'destroy'], snapshotDict=None,
+                      dryRun=False):
+    '''destroy the snapshots snaps of fs with as few zfs destroy calls as
+    possible, using range and comma syntax.  Return the number of bytes
+    reclaimed (or that would be, if dryRun)'''
+    if snapshotDict is None:
+        snapshotDict = get_scoped_snapshot_dict([fs])
+    cmd = cmd + ['-vp'] + (dryRun and ['-n'] or [])
+    host = split_host(fs)[0]
+    reclaim = 0
+    for spec in get_destroy_specs(fs, snaps, snapshotDict):
+        for line in iter_zfs_lines(host_cmd(host, cmd + [spec])):
+            t = line.split('\t')
+            if t[0] == 'reclaim':
+                reclaim += int(t[1])
+    if not dryRun: # unregister destroyed snapshots
+        with inventoryLock:
+            snapshotDict[fs].discard(set(snaps))
+    return reclaim
+
+def record_push(src, dest, snap, snapshotDict):
+    'register src@snap as received by dest in snapshotDict'
+    i, snaps = find_snapshot(src, snap, snapshotDict)
+    snapshotDict.setdefault(dest).append(snaps[i]) # txg on dest not known
 
 def create_filesystem(zfsname, cmd=['zfs', 'create']):
     'create the ZFS filesystem zfsname'
-    subprocess.check_call(cmd + [zfsname])
+    check_call(zfs_cmd(cmd, zfsname))
+
+def transfer_stream(sendCmd, recvCmd, bufferSize=TRANSFER_BUFFER,
+                    chunkSize=TRANSFER_CHUNK, src=None, dest=None):
+    '''pipe the output of sendCmd into recvCmd via a buffer of up to
+    bufferSize bytes, filled by a pumping thread so the sender keeps
+    running while the receiver is busy.  Return number of bytes moved.
+    src and dest name the filesystems in its trace'''
+    start = time.time()
+    sender = subprocess.Popen(sendCmd, stdout=subprocess.PIPE)
+    try:
+        receiver = subprocess.Popen(recvCmd, stdin=subprocess.PIPE)
+    except OSError:
+        sender.kill()
+        sender.wait()
+        raise
+    buf = Queue.Queue(max(1, bufferSize // chunkSize))
+    aborted = threading.Event()
+    def pump(): # copy sender output into buf, ending with '' at EOF
+        data = None
+        try:
+            while data != '':
+                data = sender.stdout.read(chunkSize)
+                while not aborted.is_set():
+                    try:
+                        buf.put(data, True, 1)
+                        break
+                    except Queue.Full:
+                        pass
+                if aborted.is_set():
+                    return
+        finally:
+            if data != '' and not aborted.is_set(): # pump failed
+                buf.put('')
+    pumpThread = threading.Thread(target=pump)
+    pumpThread.daemon = True
+    pumpThread.start()
+    nbytes = 0
+    try:
+        while True:
+            try:
+                data = buf.get(True, 1) # timeout keeps Ctrl-C responsive
+            except Queue.Empty:
+                continue
+            if not data:
+                break
+            receiver.stdin.write(data)
+            nbytes += len(data)
+    except IOError: # receiver exited early
+        aborted.set()
+        sender.kill()
+    try:
+        receiver.stdin.close()
+    except IOError:
+        pass
+    pumpThread.join()
+    sender.stdout.close()
+    receiveStatus = receiver.wait()
+    sendStatus = sender.wait()
+    pair = src and dict(src=src, dest=dest) or {}
+    add_trace(sendCmd, start, sendStatus, bytes=nbytes, **pair)
+    add_trace(recvCmd, start, receiveStatus, bytes=nbytes, **pair)
+    if receiveStatus:
+        raise subprocess.CalledProcessError(receiveStatus, recvCmd)
+    if sendStatus:
+        raise subprocess.CalledProcessError(sendStatus, sendCmd)
+    return nbytes
+
+def record_bytes(dest, nbytes):
+    'add nbytes to the count of bytes received by dest'
+    transferBytes[dest] = transferBytes.get(dest, 0) + nbytes
+
+def format_bytes(nbytes):
+    'get human-readable size string'
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.
+    else:
+        unit = 'TB'
+    if unit == 'bytes':
+        return '%d bytes' % nbytes
+    return '%.1f %s' % (nbytes, unit)
 
-def push_incremental(src, dest, oldsnap, newsnap, cmd='zfs send -i %s %s|zfs receive %s',
-                                            readonly=False):
+def get_pool_features(pool, cmd=['zpool', 'get', '-H', '-o', 'property,value', 'all']):
+    'get dict of {feature@NAME:state} for pool'
+    try:
+        return poolFeatures[pool]
+    except KeyError:
+        pass
+    d = {}
+    for line in check_output(zfs_cmd(cmd, pool)).split('\n')[:-1]:
+        prop, value = line.split('\t')
+        if prop.startswith('feature@'):
+            d[prop] = value
+    poolFeatures[pool] = d
+    return d
+
+def negotiate_send_flags(dest, sendFlags):
+    'get the subset of zfs send flags that the zpool of dest can receive'
+    if not sendFlags:
+        return []
+    pool = zfs_pool(dest)
+    features = get_pool_features(pool)
+    flags = []
+    for flag in sendFlags:
+        feature = SEND_FLAG_FEATURES.get(flag)
+        if feature and features.get(feature, 'disabled') == 'disabled':
+            if (pool, flag) not in poolFeatures: # only warn once
+                print 'WARNING: %s cannot receive zfs send %s streams; sending without %s' \
+                      % (pool, flag, flag)
+                poolFeatures[(pool, flag)] = False
+        else:
+            flags.append(flag)
+    return flags
+
+def push_incremental(src, dest, oldsnap, newsnap, sendCmd=['zfs', 'send'],
+                     recvCmd=['zfs', 'receive', '-s'], readonly=False,
+                     intermediate=False, bufferSize=TRANSFER_BUFFER,
+                     sendFlags=()):
     '''push newsnap as incremental update from old snap to dest filesystem.
-    do not use unless SURE args cannot contain shell injection attack'''
-    oldname = src + '@' + oldsnap
-    newname = src + '@' + newsnap
+    If intermediate, also push all snapshots between oldsnap and newsnap.
+    sendFlags (e.g. -c, -L, -e, -w) are used if dest can receive them.
+    Return number of bytes transferred'''
+    sendCmd = zfs_cmd(sendCmd + negotiate_send_flags(dest, sendFlags) +
+                      [intermediate and '-I' or '-i', '@' + oldsnap],
+                      src + '@' + newsnap)
+    recvCmd = zfs_cmd(recvCmd, dest)
     try:
-        subprocess.check_call(cmd % (oldname, newname, dest), shell=True)
+        nbytes = transfer_stream(sendCmd, recvCmd, bufferSize, src=src, dest=dest)
     except subprocess.CalledProcessError:
         if readonly: # retry push by treating dest as readonly archive
-            subprocess.check_call(['zfs', 'rollback', dest + '@' + oldsnap])
-            subprocess.check_call(['zfs', 'set', 'readonly=on', dest])
-            subprocess.check_call(cmd % (oldname, newname, dest), shell=True)
+            check_call(zfs_cmd(['zfs', 'rollback'], dest + '@' + oldsnap))
+            check_call(zfs_cmd(['zfs', 'set', 'readonly=on'], dest))
+            nbytes = transfer_stream(sendCmd, recvCmd, bufferSize, src=src, dest=dest)
         else:
             raise ZfsReceiveError
+    record_bytes(dest, nbytes)
+    return nbytes
 
 
-def push_root(src, dest, newsnap, cmd='zfs send %s|zfs receive %s'):
+def push_root(src, dest, newsnap, sendCmd=['zfs', 'send'],
+              recvCmd=['zfs', 'receive', '-s'], snapshotDict=None,
+              bufferSize=TRANSFER_BUFFER, sendFlags=()):
     '''push newsnap from src to create dest filesystem.
-    do not use unless SURE args cannot contain shell injection attack'''
+    sendFlags (e.g. -c, -L, -e, -w) are used if dest can receive them.
+    Return number of bytes transferred'''
     newname = src + '@' + newsnap
-    subprocess.check_call(cmd % (newname, dest), shell=True)
-
+    sendCmd = zfs_cmd(sendCmd + negotiate_send_flags(dest, sendFlags), newname)
+    nbytes = transfer_stream(sendCmd, zfs_cmd(recvCmd, dest), bufferSize,
+                             src=src, dest=dest)
+    record_bytes(dest, nbytes)
+    if snapshotDict is not None: # register new filesystem
+        snapshotDict[dest] = []
+        record_push(src, dest, newsnap, snapshotDict)
+    return nbytes
+
+
+def get_resume_token(fs, cmd=['zfs', 'get', '-H', '-o', 'value',
+                                'receive_resume_token']):
+    'get the receive_resume_token of fs, or None if it has none'
+    token = check_output(zfs_cmd(cmd, fs)).strip()
+    if token != '-':
+        return token
+
+def get_resume_toname(token, srcHost=None, cmd=['zfs', 'send', '-nv', '-t']):
+    '''get name of the snapshot that a receive resume token will send,
+    from srcHost (this host if None)'''
+    prefix = srcHost and srcHost + ':' or ''
+    for line in check_output(host_cmd(srcHost, cmd + [token])).split('\n'):
+        line = line.strip()
+        if line.startswith('toname = '):
+            return prefix + line[len('toname = '):]
+
+def resume_receive(dest, snapshotDict, src=None, sendCmd=['zfs', 'send'],
+                   recvCmd=['zfs', 'receive', '-s'], bufferSize=TRANSFER_BUFFER,
+                   discard=True):
+    '''finish an interrupted receive into dest, if any, using its resume token
+    to send the rest of the stream from the host of src (this host if None).
+    If the token is unusable (its snapshot is gone) and discard is True,
+    discard the partial state.  If the resumed stream fails, keep the
+    partial state for next time and raise the error.
+    Return name of the snapshot that was received, or None'''
+    tokens = getattr(snapshotDict, 'resumeTokens', {})
+    token = tokens.get(dest)
+    if not token:
+        return None
+    srcHost = src and split_host(src)[0]
+    try:
+        toname = get_resume_toname(token, srcHost)
+    except subprocess.CalledProcessError:
+        toname = None
+    if toname and toname.split('@')[0] in snapshotDict:
+        try:
+            get_snaps(snapshotDict, toname.split('@')[0]).find(toname.split('@')[1])
+        except KeyError: # destroyed on the sender since
+            toname = None
+    if not toname:
+        if not discard:
+            raise ValueError('cannot resume receive into %s: its snapshot is gone' % dest)
+        print 'WARNING: cannot resume receive into %s; discarding partial receive state' % dest
+        abort_receive(dest, snapshotDict)
+        return None
+    print 'resuming interrupted receive of %s into %s...' % (toname, dest)
+    try:
+        nbytes = transfer_stream(host_cmd(srcHost, sendCmd + ['-t', token]),
+                                 zfs_cmd(recvCmd, dest), bufferSize,
+                                 src=toname.split('@')[0], dest=dest)
+    except subprocess.CalledProcessError:
+        print 'WARNING: resumed receive into %s failed; keeping its partial state' % dest
+        raise
+    del tokens[dest]
+    record_bytes(dest, nbytes)
+    src, snap = toname.split('@')
+    if src in snapshotDict:
+        record_push(src, dest, snap, snapshotDict)
+    else: # source not in our inventory, so relist dest
+        refresh_snapshots(dest, snapshotDict)
+    return snap
+
+def abort_receive(dest, snapshotDict=None, cmd=['zfs', 'receive', '-A']):
+    'discard the partial receive state of dest'
+    check_call(zfs_cmd(cmd, dest))
+    if snapshotDict is not None:
+        getattr(snapshotDict, 'resumeTokens', {}).pop(dest, None)
+        if dest in snapshotDict and not snapshotDict[dest]:
+            del snapshotDict[dest] # aborting a full receive removes dest
 
 def dest_zpool_exists(dest, snapshotDict):
     'check whether dest root available, so we can create dest'
@@ -156,38 +1027,46 @@ def dest_zpool_exists(dest, snapshotDict):
 def create_missing_parents(dest, snapshotDict):
     'ensure that parent filesystems exist'
     l = dest.split('/')
-    for end in range(2, len(l)): # don't try to create root or dest!
-        parent = '/'.join(l[:end])
-        if parent not in snapshotDict:
-            create_filesystem(parent)
-            snapshotDict[parent] = [] # register repo with no snapshots
-
-def clone_initial_snapshot(src, dest, snapshotDict, cloneSnap=0):
-    'copy src[cloneSnap] snapshot to dest and register it'
+    with inventoryLock: # parallel syncs may share parents
+        for end in range(2, len(l)): # don't try to create root or dest!
+            parent = '/'.join(l[:end])
+            if parent not in snapshotDict:
+                create_filesystem(parent)
+                snapshotDict[parent] = [] # register repo with no snapshots
+
+def clone_initial_snapshot(src, dest, snapshotDict, cloneSnap=0, **kwargs):
+    '''copy src[cloneSnap] snapshot to dest and register it.
+    kwargs (e.g. bufferSize, sendFlags) are passed to push_root()'''
     print 'Creating %s by cloning initial snapshot...' % dest
     create_missing_parents(dest, snapshotDict) # ensure parents exist
-    push_root(src, dest, snapshotDict[src][cloneSnap][0])
-    snapshotDict[dest] = [snapshotDict[src][cloneSnap]] # register new clone
+    push_root(src, dest, snapshotDict[src][cloneSnap][0],
+              snapshotDict=snapshotDict, **kwargs) # registers new clone
 
 def find_ff_start(src, dest, snapshotDict=None, createIfMissing=False,
-                  cloneSnap=0):
-    'find start point in src to fast-forward update dest'
+                  cloneSnap=0, **kwargs):
+    '''find start point in src to fast-forward update dest.
+    kwargs are passed to clone_initial_snapshot() if creating dest'''
     if not snapshotDict:
-        snapshotDict = get_snapshot_dict()
-    srcSnaps = snapshotDict[src]
-    srcGUIDs = [t[1] for t in srcSnaps]
+        snapshotDict = get_scoped_snapshot_dict([src, dest])
+    srcSnaps = get_snaps(snapshotDict, src)
     try:
-        destSnaps = snapshotDict[dest]
+        destSnaps = get_snaps(snapshotDict, dest)
     except KeyError: # dest filesystem does not exist
         if createIfMissing and dest_zpool_exists(dest, snapshotDict):
-            clone_initial_snapshot(src, dest, snapshotDict, cloneSnap)
-            destSnaps = snapshotDict[dest] = [srcSnaps[cloneSnap]]
+            clone_initial_snapshot(src, dest, snapshotDict, cloneSnap,
+                                   **kwargs)
+            destSnaps = get_snaps(snapshotDict, dest)
         else:
             return [t[0] for t in srcSnaps], None, None, snapshotDict
-    destCurrent = destSnaps[-1][1] # last snapshot GUID
+    if not destSnaps or dest in getattr(snapshotDict, 'resumeTokens', {}):
+        # dest has no complete snapshot yet, or a partial receive that
+        # must be resumed before it can accept new snapshots
+        return [t[0] for t in srcSnaps], [t[0] for t in destSnaps], None, \
+               snapshotDict
+    destCurrent = destSnaps.guids[-1] # last snapshot GUID
     try: # find matching GUID
-        ffstart = srcGUIDs.index(destCurrent)
-    except ValueError: # HEAD of dest not found in src snapshot history?!
+        ffstart = srcSnaps.find_guid(destCurrent)
+    except KeyError: # HEAD of dest not found in src snapshot history?!
         ffstart = None
     return ([t[0] for t in srcSnaps], [t[0] for t in destSnaps], ffstart,
             snapshotDict)
@@ -196,10 +1075,18 @@ class CannotFastForwardError(ValueError):
     pass
 
 def update_dest(src, dest, snapshotDict=None, verbose=False,
-                createIfMissing=False, readonly=False):
+                createIfMissing=False, readonly=False, remoteOpts=None):
     'push fast-forward update to bring dest up to date with src'
+    if remoteOpts is None:
+        remoteOpts = {}
+    if not snapshotDict:
+        snapshotDict = get_scoped_snapshot_dict([src, dest])
+    pushArgs = dict(bufferSize=remoteOpts.get('bufferSize', TRANSFER_BUFFER),
+                    sendFlags=remoteOpts.get('sendFlags', ()))
+    resume_receive(dest, snapshotDict, src,
+                   bufferSize=pushArgs['bufferSize']) # finish partial receive first
     srcSnaps, destSnaps, i, snapshotDict = find_ff_start(src, dest,
-         snapshotDict, createIfMissing)
+         snapshotDict, createIfMissing, **pushArgs)
     if i is None:
         if destSnaps is None:
             if verbose:
@@ -207,33 +1094,80 @@ def update_dest(src, dest, snapshotDict=None, verbose=False,
             return None
         raise CannotFastForwardError('cannot push %s to %s by fast-forward'
                                      % (src, dest))
-    return push_ff(src, dest, srcSnaps[i:], readonly=readonly)
+    return push_ff(src, dest, srcSnaps[i:], readonly=readonly,
+                   snapshotDict=snapshotDict,
+                   intermediate=remoteOpts.get('intermediate', True),
+                   **pushArgs)
     
-def push_ff(src, dest, ffSnaps, readonly=False):
-    'push incremental snapshots to fast-forward dest to match src'
+def push_ff(src, dest, ffSnaps, readonly=False, snapshotDict=None,
+            intermediate=True, **kwargs):
+    '''push incremental snapshots to fast-forward dest to match src.
+    If intermediate, push them all as a single zfs send -I stream,
+    falling back to one stream per snapshot if that fails.
+    kwargs (e.g. bufferSize, sendFlags) are passed to push_incremental()'''
+    if intermediate and len(ffSnaps) > 2:
+        try:
+            push_incremental(src, dest, ffSnaps[0], ffSnaps[-1],
+                             readonly=readonly, intermediate=True, **kwargs)
+        except (ZfsReceiveError, subprocess.CalledProcessError):
+            print 'WARNING: zfs send -I to %s failed; retrying one snapshot at a time' % dest
+            ffSnaps = find_ff_restart(src, dest, ffSnaps, snapshotDict)
+        else:
+            if snapshotDict is not None: # keep inventory up to date
+                for snap in ffSnaps[1:]:
+                    record_push(src, dest, snap, snapshotDict)
+            return ffSnaps[-1] # report HEAD that was pushed to dest
     head = None
     for i,baseSnap in enumerate(ffSnaps[:-1]):
         head = ffSnaps[i + 1]
-        push_incremental(src, dest, baseSnap, head, readonly=readonly)
+        push_incremental(src, dest, baseSnap, head, readonly=readonly,
+                         **kwargs)
+        if snapshotDict is not None: # keep inventory up to date
+            record_push(src, dest, head, snapshotDict)
     return head # report HEAD that was pushed to dest
 
-def sync_ff(src, dest, snapshotDict=None, createIfMissing=False, readonly=False):
+def find_ff_restart(src, dest, ffSnaps, snapshotDict=None):
+    'find the part of ffSnaps still to push, after a partial -I receive'
+    if snapshotDict is None:
+        snapshotDict = SnapshotInventory()
+    if src not in snapshotDict:
+        refresh_snapshots(src, snapshotDict)
+    srcSnaps = get_snaps(snapshotDict, src)
+    if get_resume_token(dest): # return to last complete snapshot
+        abort_receive(dest, snapshotDict)
+    destSnaps = refresh_snapshots(dest, snapshotDict) # get actual HEAD
+    try:
+        head = srcSnaps.names[srcSnaps.find_guid(destSnaps.guids[-1])]
+        return ffSnaps[ffSnaps.index(head):]
+    except (IndexError, KeyError, ValueError): # HEAD of dest not in ffSnaps?!
+        raise ZfsReceiveError('cannot find HEAD of %s in %s' % (dest, src))
+
+def sync_ff(src, dest, snapshotDict=None, createIfMissing=False, readonly=False,
+            remoteOpts=None):
     'sync src and dest by fast-forward in either direction'
     if snapshotDict is None:
-        snapshotDict = get_snapshot_dict()
+        snapshotDict = get_scoped_snapshot_dict([src, dest])
+    srcBytes, destBytes = transferBytes.get(src, 0), transferBytes.get(dest, 0)
     try:
         snap = update_dest(src, dest, snapshotDict,
-                           createIfMissing=createIfMissing, readonly=readonly)
+                           createIfMissing=createIfMissing, readonly=readonly,
+                           remoteOpts=remoteOpts)
         if snap:
-            print 'pushed %s@%s to %s' % (src, snap, dest)
+            print 'pushed %s@%s to %s (%s)' % (src, snap, dest,
+                        format_bytes(transferBytes[dest] - destBytes))
     except CannotFastForwardError:
         snap = update_dest(dest, src, snapshotDict,
-                           createIfMissing=createIfMissing, readonly=readonly)
+                           createIfMissing=createIfMissing, readonly=readonly,
+                           remoteOpts=remoteOpts)
         if snap:
-            print 'pulled %s@%s to %s' % (dest, snap, src)
+            print 'pulled %s@%s to %s (%s)' % (dest, snap, src,
+                        format_bytes(transferBytes[src] - srcBytes))
     
 def read_json_config(path=MAPPATH, autoCreate=True):
-    'read config dict'
+    '''read config dict (from zgit daemon memory if running in it).
+    Needs no lock, since writers replace the file atomically'''
+    if warmInventory and path == MAPPATH:
+        return warmInventory.get_config()
     path = os.path.expanduser(path)
     try:
         with open(path, 'r') as ifile:
@@ -248,22 +1182,83 @@ def read_json_map(path=MAPPATH, autoCreate=True):
     'get map dict {SRC:[DEST1, DEST2,...], SRC:[DEST1,...]}'
     return read_json_config(path, autoCreate)['backupMap']
 
+@contextlib.contextmanager
+def config_lock(path=MAPPATH):
+    'hold exclusive lock for changing config file path'
+    path = os.path.expanduser(path)
+    with open(path + '.lock', 'a') as lockFile: # config itself is replaced by rename
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
 def write_json_config(configDict, path=MAPPATH, indent=2):
-    'write config dict'
+    '''write config dict, replacing the file atomically so readers see
+    either the old or the new config.  Use update_json_config() to change
+    just part of it'''
     path = os.path.expanduser(path)
-    with open(path, 'w') as ifile:
-        json.dump(configDict, ifile, indent=indent)
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'w') as ofile:
+        json.dump(configDict, ofile, indent=indent)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+    os.rename(tmpPath, path)
+
+def update_json_config(update, path=MAPPATH):
+    '''apply update(configDict) to the current config file while holding
+    its lock, so concurrent zgit commands cannot lose each other's changes.
+    Return the result of update()'''
+    path = os.path.expanduser(path) # read the file, not zgit daemon's copy
+    with config_lock(path):
+        configDict = read_json_config(path)
+        result = update(configDict)
+        write_json_config(configDict, path)
+    return result
 
 def write_json_map(backupMap, path=MAPPATH):
     'write backup map dict {SRC:[DEST1, DEST2,...], SRC:[DEST1,...]}'
-    path = os.path.expanduser(path)
-    configDict = read_json_config(path)
-    configDict['backupMap'] = backupMap # update backupMap while retaining other data
-    write_json_config(configDict, path)
+    def update(configDict): # update backupMap while retaining other data
+        configDict['backupMap'] = backupMap
+    update_json_config(update, path)
+
+def save_init(src, path=MAPPATH):
+    'add src with no remotes to the backup map in config file'
+    update_json_config(lambda configDict:do_init(src, configDict['backupMap']), path)
+
+def save_remote(src, t, path=MAPPATH):
+    'add (or replace) remote t = (remote, dest[, options]) of src in config file'
+    def update(configDict):
+        dests = configDict['backupMap'].setdefault(src, [])
+        dests[:] = [old for old in dests if old[1] != t[1]] + [list(t)]
+    update_json_config(update, path)
+
+def save_remote_removal(src, dest, remote=None, path=MAPPATH):
+    'remove remote of src from config file'
+    update_json_config(lambda configDict:rm_backup_mapping(src, dest, remote,
+                                                           configDict['backupMap']), path)
+
+def save_lv(lvPath, zfsName, blockOpts=None, path=MAPPATH):
+    '''add (or replace) LVM mapping lvPath --> zfsName in config file,
+    with its block-level commit options, if any'''
+    def update(configDict):
+        configDict.setdefault('lvmMap', {})[lvPath] = zfsName
+        if blockOpts is not None:
+            configDict.setdefault('lvmBlock', {})[lvPath] = blockOpts
+        else:
+            configDict.get('lvmBlock', {}).pop(lvPath, None)
+    update_json_config(update, path)
 
 
+def remote_options(t):
+    'get options dict of a backupMap entry t = (remote, dest[, options])'
+    if len(t) > 2:
+        return t[2]
+    return {}
+
 def add_backup_mapping(src, dest, remote='backup', backupMap=None,
-                       snapshotDict=None, deferPush=False, readonly=False):
+                       snapshotDict=None, deferPush=False, readonly=False,
+                       remoteOpts=None):
     'add src -> dest to backupMap, pushing root snapshot if dest does not exist'
     if backupMap is None:
         backupMap = {}
@@ -274,11 +1269,15 @@ def add_backup_mapping(src, dest, remote='backup', backupMap=None,
     Note: you MUST provide the --create option to your next zgit sync to create it!''' % dest
         else:
             print 'creating new ZFS remote %s by pushing initial snapshot...' % dest
-            push_root(src, dest, snapshotDict[src][0][0])
+            push_root(src, dest, snapshotDict[src][0][0], snapshotDict=snapshotDict,
+                      sendFlags=(remoteOpts or {}).get('sendFlags', ()))
             if readonly:
                 print 'Configuring %s as readonly archive.' % dest
-                subprocess.check_call(['zfs', 'set', 'readonly=on', dest])
-    backupMap.setdefault(src, []).append((remote, dest))
+                check_call(zfs_cmd(['zfs', 'set', 'readonly=on'], dest))
+    if remoteOpts:
+        backupMap.setdefault(src, []).append((remote, dest, remoteOpts))
+    else:
+        backupMap.setdefault(src, []).append((remote, dest))
     return backupMap
 
 def rm_backup_mapping(src, dest, remote=None, backupMap=None):
@@ -302,12 +1301,13 @@ def backup_sources(backupMap=None):
     'update all backup destinations in backup map'
     if backupMap is None:
         backupMap = read_json_map()
-    snapshotDict = get_snapshot_dict()
+    snapshotDict = get_scoped_snapshot_dict(get_map_names(backupMap))
     for src, dests in backupMap.items():
         for t in dests:
-            remote, dest = t
+            remote, dest = t[:2]
             try:
-                snap = update_dest(src, dest, snapshotDict)
+                snap = update_dest(src, dest, snapshotDict,
+                                   remoteOpts=remote_options(t))
                 if snap:
                     print 'pushed %s@%s to %s' % (src, snap, dest)
             except CannotFastForwardError:
@@ -315,12 +1315,18 @@ def backup_sources(backupMap=None):
 
 
 
-def get_zfs_name(mountDict=None, path=None):
+def get_zfs_name(mountDict=None, path=None, cmd=['zfs', 'list', '-H', '-o', 'name']):
     'get filesystem name for path, or current dir if not specified'
-    if mountDict is None:
-        mountDict = get_mount_dict()
     if path is None:
         path = os.getcwd()
+    if mountDict is None and warmInventory:
+        mountDict = warmInventory.mountDict # None unless warm
+    if mountDict is None: # ask ZFS about just this path
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return check_output(cmd + [path], stderr=devnull).strip()
+            except subprocess.CalledProcessError:
+                raise ValueError('%s is not in a ZFS mount' % path)
     l = mountDict.items()
     l.sort(lambda x,y:cmp(y[1], x[1])) # ensure long paths first
     for name, mountpoint in l:
@@ -339,6 +1345,156 @@ def get_backup_src(src=None, path=None):
     return src, backupMap
 
 
+###############################################################
+# persistent snapshot catalog
+
+class SnapshotCatalog(object):
+    '''on-disk catalog of snapshots keyed by GUID.  Only snapshots
+    created since the last refresh of their pool have their properties
+    fetched from ZFS; pools that are offline keep their last-known state'''
+    def __init__(self, path=CATALOGPATH):
+        self.db = sqlite3.connect(os.path.expanduser(path))
+        self.db.text_factory = str
+        if self.db.execute('pragma user_version').fetchone()[0] != CATALOG_VERSION:
+            self.db.executescript('''
+drop table if exists snapshots;
+drop table if exists filesystems;
+drop table if exists pools;
+pragma user_version = %d;''' % CATALOG_VERSION)
+        self.db.executescript('''
+create table if not exists snapshots (host text, fs text, guid text,
+  snap text, createtxg integer, creation integer, commitmsg text,
+  primary key (host, fs, guid));
+create index if not exists snapshots_guid on snapshots (guid);
+create table if not exists filesystems (host text, fs text, pool text,
+  token text, primary key (host, fs));
+create table if not exists pools (host text, pool text, lasttxg integer,
+  online integer, primary key (host, pool));''')
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, host=None, poolCmd=['zpool', 'list', '-H', '-o', 'name'],
+                listCmd=['zfs', 'list', '-H', '-p', '-t', 'filesystem,volume,snapshot',
+                         '-o', 'name,guid,createtxg,receive_resume_token']):
+        '''update the catalog entries of all online pools on host, streaming
+        the zfs list output through a temporary table so that the host's
+        full listing is never held in memory'''
+        key = host or ''
+        c = self.db.cursor()
+        c.executescript('''
+drop table if exists temp.listing;
+create temp table listing (fs text, guid text, snap text, pool text,
+  createtxg integer, token text);''') # snap is null for filesystems
+        try:
+            pools = set(check_output(host_cmd(host, poolCmd)).split())
+            c.executemany('insert into listing values (?, ?, ?, ?, ?, ?)',
+                          (parse_catalog_line(s)
+                           for s in iter_zfs_list(host_cmd(host, listCmd))))
+        except (subprocess.CalledProcessError, OSError):
+            print 'WARNING: cannot list ZFS filesystems on %s; using catalog' % host
+            pools = set()
+            c.execute('delete from listing')
+        c.execute('create index temp.listing_fs_guid on listing (fs, guid)')
+        newSnaps = c.execute('''select l.fs, l.guid, l.snap, l.createtxg
+          from listing l left join pools p on p.host=? and p.pool=l.pool
+          where l.snap is not null and (l.createtxg > coalesce(p.lasttxg, -1)
+            or not exists (select 1 from snapshots s
+              where s.host=? and s.fs=l.fs and s.guid=l.guid))''',
+                             (key, key)).fetchall() # not in catalog as of last refresh
+        info = get_snapshots_info(['%s@%s' % (t[0], t[2]) for t in newSnaps], host)
+        maxTxg = dict(c.execute('''select pool, max(createtxg) from listing
+          where snap is not null group by pool'''))
+        lastTxg = dict(c.execute('select pool, lasttxg from pools where host=?',
+                                 (key,)))
+        for pool in pools:
+            c.execute('delete from filesystems where host=? and pool=?', (key, pool))
+            c.execute('''delete from snapshots where host=? and (fs=? or fs like ?)
+              and not exists (select 1 from listing l
+                where l.fs=snapshots.fs and l.guid=snapshots.guid)''',
+                      (key, pool, pool + '/%')) # destroyed since last refresh
+        c.execute('''insert into filesystems select ?, fs, pool, token
+          from listing where snap is null''', (key,))
+        c.execute('''update snapshots set snap=(select l.snap from listing l
+            where l.fs=snapshots.fs and l.guid=snapshots.guid)
+          where host=? and exists (select 1 from listing l where l.fs=snapshots.fs
+            and l.guid=snapshots.guid and l.snap!=snapshots.snap)''',
+                  (key,)) # zfs rename keeps the GUID
+        c.executemany('insert or replace into snapshots values (?, ?, ?, ?, ?, ?, ?)',
+                      [(key, fs, guid, snap, txg) + info['%s@%s' % (fs, snap)]
+                       for fs, guid, snap, txg in newSnaps
+                       if '%s@%s' % (fs, snap) in info]) # unless just destroyed
+        c.execute('update pools set online=0 where host=?', (key,))
+        for pool in pools:
+            c.execute('insert or replace into pools values (?, ?, ?, 1)',
+                      (key, pool, max(maxTxg.get(pool, 0), lastTxg.get(pool, 0))))
+        c.execute('drop table temp.listing')
+        self.db.commit()
+
+    def get_inventory(self, hosts=()):
+        'get SnapshotInventory of this host and hosts from the catalog'
+        d = SnapshotInventory()
+        c = self.db.cursor()
+        for host in [None] + list(hosts):
+            key = host or ''
+            prefix = host and host + ':' or ''
+            for fs, token, online in c.execute('''select f.fs, f.token, p.online
+              from filesystems f join pools p on f.host=p.host and f.pool=p.pool
+              where f.host=?''', (key,)):
+                d[prefix + fs] = []
+                if token:
+                    d.resumeTokens[prefix + fs] = token
+                if not online:
+                    d.offline.add(prefix + fs)
+            for fs, snap, guid, creation, commitMsg, txg in c.execute('''select
+              fs, snap, guid, creation, commitmsg, createtxg from snapshots
+              where host=? order by fs, createtxg, creation''', (key,)):
+                d.setdefault(prefix + fs).append((snap, guid, creation,
+                                                  commitMsg), txg)
+        return d
+
+def parse_catalog_line(line):
+    '''get (fs, guid, snap, pool, createtxg, token) from a line of the
+    zfs list run by SnapshotCatalog.refresh(); snap is None for a filesystem'''
+    name, guid, txg, token = line.split('\t')
+    fs, snap = '@' in name and name.split('@') or (name, None)
+    return (fs, guid, snap, fs.split('/')[0], int(txg),
+            token != '-' and token or None)
+
+def get_snapshots_info(names, host=None, batchSize=200,
+                       cmd=['zfs', 'get', '-H', '-p', '-o', 'name,property,value',
+                            'creation,org.zgit:commitmsg']):
+    'get {name:(creation, commitMsg)} for snapshots on host, in batches'
+    info = {}
+    for i in range(0, len(names), batchSize):
+        props = {}
+        try:
+            output = check_output(host_cmd(host, cmd + names[i:i + batchSize]))
+        except subprocess.CalledProcessError, e: # some were destroyed meanwhile
+            output = e.output
+        for line in output.split('\n')[:-1]:
+            name, prop, value = line.split('\t')
+            props.setdefault(name, {})[prop] = value
+        for name, d in props.items():
+            commitMsg = d.get('org.zgit:commitmsg', '-')
+            info[name] = (int(d['creation']), commitMsg != '-' and commitMsg or None)
+    return info
+
+def load_inventory(hosts=(), configDict=None):
+    '''get inventory for read-only commands, from the snapshot catalog
+    unless disabled by setting "catalog" to false in MAPPATH'''
+    if configDict is None:
+        configDict = read_json_config()
+    path = configDict.get('catalog', CATALOGPATH)
+    if not path:
+        return get_snapshot_dict(hosts=hosts)
+    catalog = SnapshotCatalog(path)
+    try:
+        return get_snapshot_dict(hosts=hosts, catalog=catalog)
+    finally:
+        catalog.close()
+
+
 ###############################################################
 # command line parsing
 
@@ -354,10 +1510,7 @@ def get_base_parser():
 
 def init_cmd(path=MAPPATH):
     'initialize empty map'
-    backupMap = read_json_map(path)
-    src = get_zfs_name()
-    do_init(src, backupMap)
-    write_json_map(backupMap)
+    save_init(get_zfs_name(), path)
 
 def do_init(src, backupMap):
     if src in backupMap:
@@ -385,35 +1538,63 @@ def push_cmd():
         src = args.branch
     src, backupMap = get_backup_src(src)
     dest = None
-    for remote, zfsname in backupMap[src]:
-        if remote == args.remote:
-            dest = zfsname
+    for t in backupMap[src]:
+        if t[0] == args.remote:
+            dest = t[1]
             break
     if not dest:
         print 'no remote named %s' % args.remote
         return 1
-    update_dest(src, dest, readonly=args.readonly)
+    update_dest(src, dest, readonly=args.readonly, remoteOpts=remote_options(t))
 
 
 ##################################################################
 # diff command
 
 def diff_snapshot(src, snaps=(), snapshotDict=None, cmd=['zfs', 'diff', '-H']):
-    'get list of changed files vs. snaphot(s)'
+    '''generate changed files vs. snaphot(s), as they are read from zfs
+    diff.  Closing the generator early stops zfs diff'''
     if not snapshotDict:
-        snapshotDict = get_snapshot_dict()
+        snapshotDict = get_scoped_snapshot_dict([src])
     if not snaps:
         snaps = (snapshotDict[src][-1][0],) # diff vs. last snapshot
-    args = ['%s@%s' % (src, snaps[0])]
-    if len(snaps) > 1:
-        args.append('%s@%s' % (src, snaps[1]))
-    lines = subprocess.check_output(cmd + args).split('\n')[:-1]
-    return [line.split('\t') for line in lines]
-    
+    args = ['%s@%s' % (split_host(src)[1], snaps[1])] if len(snaps) > 1 else []
+    for line in iter_zfs_lines(zfs_cmd(cmd, src + '@' + snaps[0], *args)):
+        yield line.split('\t')
+
+def get_mountpoint(fs, cmd=['zfs', 'get', '-H', '-o', 'value', 'mountpoint']):
+    'get mountpoint of fs'
+    return check_output(zfs_cmd(cmd, fs)).strip()
+
+def summarize_diffs(diffs, mountpoint):
+    '''count added (+), removed (-), modified (M) and renamed (R) entries
+    in diffs per top-level directory under mountpoint (entries in the
+    top directory itself count as "."), without keeping the diffs'''
+    counts = {}
+    prefix = mountpoint.rstrip('/') + '/'
+    for diff in diffs:
+        path = diff[1]
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        top = '/' in path and path.split('/')[0] or '.'
+        c = counts.setdefault(top, dict.fromkeys('+-MR', 0))
+        c[diff[0]] = c.get(diff[0], 0) + 1
+    return counts
+
+def print_summary(counts):
+    'print counts from summarize_diffs() as a table'
+    print '%8s %8s %8s %8s  %s' % ('added', 'removed', 'modified', 'renamed',
+                                   'directory')
+    for top in sorted(counts):
+        c = counts[top]
+        print '%8d %8d %8d %8d  %s' % (c['+'], c['-'], c['M'], c['R'], top)
+
 def get_diff_args():
     parser = get_base_parser()
+    parser.add_argument('--summary', action='store_true',
+                        help='count changes per top-level directory')
     parser.add_argument('commits', help='snapshot name(s) to diff',
-                        nargs=argparse.REMAINDER)
+                        nargs='*')
     return parser.parse_args()
 
 def diff_cmd():
@@ -421,39 +1602,102 @@ def diff_cmd():
     args = get_diff_args()
     src = get_zfs_name()
     diffs = diff_snapshot(src, args.commits)
-    print_diffs(diffs)
+    if args.summary:
+        print_summary(summarize_diffs(diffs, get_mountpoint(src)))
+    else:
+        print_diffs(diffs)
 
 
 #################################################################
 # status command
 
-def do_status(src, dests=None, nmax=None):
+def do_status(src, dests=None, nmax=None, written=None, summary=False):
     'list files that changed vs. last commit'
+    if written and written.get(src) == 0: # nothing written since last commit
+        return
     diffs = diff_snapshot(src)
-    print_diffs(diffs)
+    if summary:
+        print_summary(summarize_diffs(diffs, get_mountpoint(src)))
+    else:
+        print_diffs(diffs, nmax)
 
 def print_diffs(diffs, nmax=None):
-    'print ZFS diff output as-is'
-    for diff in diffs[:nmax]:
+    'print ZFS diff output as-is, stopping after nmax entries'
+    for i, diff in enumerate(diffs):
+        if nmax and i >= nmax:
+            print '...'
+            diffs.close() # no need for zfs diff to finish
+            break
         print '\t'.join(diff)
-    if nmax and len(diffs) > nmax:
-        print '...'
+
+def get_status_args():
+    parser = get_base_parser()
+    parser.add_argument('--all', action='store_true',
+                        help='status of all zgit-registered filesystems')
+    parser.add_argument('--summary', action='store_true',
+                        help='count changes per top-level directory')
+    return parser.parse_args()
 
 def status_cmd():
+    args = get_status_args()
+    if args.all:
+        return status_all(summary=args.summary)
     src = get_zfs_name()
-    return do_status(src)
-
-def commit_if_changed(src, dests=None, nmax=None,
-                      commitMsg='backup latest changes'):
-    'if changed, commit and backup'
+    return do_status(src, summary=args.summary)
+
+def status_all(**kwargs):
+    'list changed files of all filesystems in backup map that were written to'
+    return run_all(written=get_written(read_json_map()), **kwargs)
+
+def get_written(names, cmd=['zfs', 'get', '-H', '-p', '-o', 'name,value', 'written']):
+    '''get {fs:bytes written since its last snapshot} with one zfs get
+    per host.  Names that do not exist are left out'''
+    byHost = {}
+    for name in names:
+        host, fs = split_host(name)
+        byHost.setdefault(host, []).append(fs)
+    written = {}
+    for host, datasets in byHost.items():
+        prefix = host and host + ':' or ''
+        try:
+            for line in iter_zfs_lines(host_cmd(host, cmd + datasets), True):
+                fs, value = line.split('\t')
+                if value.isdigit():
+                    written[prefix + fs] = int(value)
+        except (subprocess.CalledProcessError, OSError):
+            print 'WARNING: cannot get written property on %s' % host
+    return written
+
+def is_changed(src, written=None, snapshotDict=None):
+    '''check if src changed since its last snapshot, using its written
+    property if available and zfs diff only as a fallback'''
+    if written and src in written:
+        return written[src] > 0
     try:
-        diffs = diff_snapshot(src)
+        for diff in diff_snapshot(src, snapshotDict=snapshotDict):
+            return True # one changed file is enough
+        return False
     except subprocess.CalledProcessError:
         print 'WARNING: zfs diff crashed on %s.  Assuming modified.' % src
-        diffs = True
-    if diffs:
-        snap = create_snapshot(src, commitMsg=commitMsg)
+        return True
+
+def commit_if_changed(src, dests=None, nmax=None,
+                      commitMsg='backup latest changes', snapshotDict=None,
+                      written=None):
+    'if changed, commit and backup'
+    commit_changed([src], commitMsg, snapshotDict, written)
+
+def commit_changed(srcs, commitMsg='backup latest changes', snapshotDict=None,
+                   written=None):
+    '''commit all of srcs that changed since their last commit, as one
+    atomic snapshot per pool, and return the list of new snapshots'''
+    changed = [src for src in srcs if is_changed(src, written, snapshotDict)]
+    if not changed:
+        return []
+    snaps = create_snapshots(changed, commitMsg=commitMsg, snapshotDict=snapshotDict)
+    for snap in snaps:
         print 'Committed snapshot %s' % snap
+    return snaps
 
 #########################################################################
 # sync command
@@ -463,17 +1707,403 @@ def get_sync_args():
     parser.add_argument('--all', action='store_true', help='synchronize all zgit-registered filesystems')
     parser.add_argument('--create', action='store_true', help='create filesystem if missing')
     parser.add_argument('--readonly', action='store_true', help='mark remote as readonly archive')
+    add_jobs_args(parser)
+    add_dry_run_arg(parser)
     return parser.parse_args()
 
-    
-def do_syncs(src, dests, nmax=None, createIfMissing=False, readonly=False):
+def add_dry_run_arg(parser):
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only print the transfer plan, sending nothing')
+
+def add_jobs_args(parser, poolJobs=1):
+    'add options controlling parallel transfers'
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='maximum number of transfers to run at once')
+    parser.add_argument('--src-pool-jobs', type=int, default=4,
+                        help='maximum number of transfers reading from one zpool at once')
+    parser.add_argument('--dest-pool-jobs', type=int, default=poolJobs,
+                        help='maximum number of transfers writing to one zpool at once')
+    parser.add_argument('--pool-jobs', type=int,
+                        help='set both --src-pool-jobs and --dest-pool-jobs')
+
+def get_pool_jobs(args):
+    'get (srcPoolJobs, destPoolJobs) from add_jobs_args() options'
+    if args.pool_jobs:
+        return args.pool_jobs, args.pool_jobs
+    return args.src_pool_jobs, args.dest_pool_jobs
+
+def get_backup_args():
+    parser = get_base_parser()
+    add_jobs_args(parser)
+    parser.add_argument('--vg-jobs', type=int, default=2,
+                        help='maximum number of LVM volumes per volume group to commit at once')
+    add_dry_run_arg(parser)
+    return parser.parse_args()
+
+def do_syncs(src, dests, nmax=None, createIfMissing=False, readonly=False,
+             scheduler=None, snapshotDict=None, dryRun=False):
+    '''sync src with each of its dests, or queue these syncs on scheduler.
+    If dryRun, just print the transfer plan'''
+    if snapshotDict is None:
+        snapshotDict = get_scoped_snapshot_dict(get_map_names({src:dests}))
+    if dryRun:
+        plan_transfers({src:dests}, snapshotDict, createIfMissing)
+        return 0
     for t in dests:
+        if scheduler:
+            scheduler.add((src, t[1]), sync_ff, (src, t[1]), src, t[1],
+                          snapshotDict, createIfMissing=createIfMissing,
+                          readonly=readonly, remoteOpts=remote_options(t))
+            continue
         try:
-            sync_ff(src, t[1], createIfMissing=createIfMissing, readonly=readonly)
+            sync_ff(src, t[1], snapshotDict, createIfMissing=createIfMissing,
+                    readonly=readonly, remoteOpts=remote_options(t))
         except CannotFastForwardError:
             print 'Cannot fast-forward either %s or %s.  Recursive merge not yet supported!' % (src, t[1])
         except ZfsReceiveError:
             print 'ERROR: sync skipped. Consider using --readonly option'
+        except subprocess.CalledProcessError as e: # e.g. resumed receive failed again
+            print 'ERROR: sync of %s with %s skipped: %s' % (src, t[1], describe_error(e))
+
+
+def sync_all(jobs=4, poolJobs=(4, 1), snapshotDict=None, dryRun=False, scheduler=None,
+             waitFor=None, **kwargs):
+    '''sync all repos in backup map, running independent transfers in
+    parallel, largest first, at most poolJobs (srcPoolJobs, destPoolJobs)
+    reading from and writing to each zpool.  If dryRun, just print the
+    transfer plan.  If scheduler is given, run the syncs along with the jobs already queued
+    on it, syncing each filesystem in waitFor {fs:key} only once its
+    job key has succeeded'''
+    backupMap = read_json_map()
+    if snapshotDict is None: # one inventory shared by all syncs
+        snapshotDict = get_scoped_snapshot_dict(get_map_names(backupMap))
+    set_phase('plan')
+    plan = plan_transfers(backupMap, snapshotDict,
+                          kwargs.get('createIfMissing', False), jobs, poolJobs)
+    if dryRun:
+        return 0
+    set_phase('transfers')
+    if scheduler is None:
+        scheduler = TransferScheduler(jobs, *poolJobs)
+    run_all(do_syncs, scheduler=scheduler, snapshotDict=snapshotDict, **kwargs)
+    waitFor = waitFor or {}
+    for src, dests in backupMap.items():
+        for t in dests:
+            scheduler.require((src, t[1]), [waitFor[fs] for fs in (src, t[1])
+                                             if fs in waitFor])
+    sizes = dict([(t[0], t[3]) for t in plan])
+    for key in waitFor.values(): # start these first, since syncs wait for them
+        sizes[key] = float('inf')
+    scheduler.sort_jobs(sizes)
+    status = report_failures(scheduler.run())
+    if transferBytes:
+        print 'transferred %s in total' % format_bytes(sum(transferBytes.values()))
+    return status
+
+def sync_cmd():
+    'sync this repo (or all repos) with remotes by fast-forward'
+    args = get_sync_args()
+    if args.all:
+        return sync_all(args.jobs, get_pool_jobs(args), dryRun=args.dry_run,
+                        createIfMissing=args.create, readonly=args.readonly)
+    src, backupMap = get_backup_src()
+    return do_syncs(src, backupMap[src], createIfMissing=args.create,
+                    readonly=args.readonly, dryRun=args.dry_run)
+
+def backup_cmd():
+    'commit all changed repos (including LVM volumes), then sync them all'
+    import lvmgit
+    args = get_backup_args()
+    configDict = read_json_config()
+    snapshotDict = get_scoped_snapshot_dict(get_map_names(configDict['backupMap'])
+                    + configDict.get('lvmMap', {}).values())
+    # one inventory for entire backup
+    if args.dry_run: # plan the sync of existing commits only
+        return sync_all(args.jobs, get_pool_jobs(args), snapshotDict, dryRun=True)
+    set_phase('commit')
+    lvmTargets = set(configDict.get('lvmMap', {}).values()) # committed by lvmgit below
+    srcs = [src for src in configDict['backupMap'] if src not in lvmTargets]
+    commit_changed(srcs, snapshotDict=snapshotDict, written=get_written(srcs))
+    # snapshot LVM to ZFS in parallel, syncing each as soon as it is committed
+    scheduler = TransferScheduler(args.jobs, *get_pool_jobs(args))
+    waitFor = lvmgit.queue_commits(scheduler, configDict, snapshotDict, args.vg_jobs)
+    status = sync_all(args.jobs, get_pool_jobs(args), snapshotDict, scheduler=scheduler,
+                      waitFor=waitFor)
+    lvmgit.print_snapshot_times(traceRecords)
+    return status
+
+
+##########################################################################
+# parallel transfer scheduling
+
+def zfs_pool(fs):
+    'get name of the zpool containing ZFS filesystem fs'
+    return fs.split('/')[0]
+
+def format_job_key(key):
+    'get printable name of TransferScheduler job key, e.g. (src, dest) pair'
+    return isinstance(key, tuple) and ' <--> '.join(key) or key
+
+class DependencyError(ValueError):
+    pass
+
+class TransferScheduler(object):
+    '''run queued jobs on a pool of worker threads.  A job locks the ZFS
+    filesystems it touches, and counts against the concurrency limits of
+    the zpools it reads from (srcPoolJobs) and writes to (destPoolJobs),
+    and of any other group it is added to (see limit()).  So one source
+    pool can feed several destination pools at once.  A job can also wait
+    for other jobs to succeed (see require())'''
+    def __init__(self, nworkers=4, srcPoolJobs=4, destPoolJobs=1):
+        self.nworkers = nworkers
+        self.srcPoolJobs = srcPoolJobs
+        self.destPoolJobs = destPoolJobs
+        self.jobs = []
+        self.results = []
+        self.busyFS = set()
+        self.srcCounts = {}
+        self.destCounts = {}
+        self.deps = {}
+        self.groups = {}
+        self.groupLimits = {}
+        self.groupCounts = {}
+        self.succeeded = set()
+        self.failed = set()
+        self.cond = threading.Condition()
+
+    def add(self, key, func, filesystems, *args, **kwargs):
+        '''queue func(*args, **kwargs) as job key, locking filesystems:
+        it reads from the first and writes to the rest (or just writes
+        to it, if only one)'''
+        pools = [zfs_pool(fs) for fs in filesystems]
+        srcPools, destPools = set(pools[:1]), set(pools[1:])
+        if len(pools) == 1:
+            srcPools, destPools = destPools, srcPools
+        self.jobs.append((key, func, set(filesystems), (srcPools, destPools),
+                          args, kwargs))
+
+    def require(self, key, deps):
+        '''make job key wait until queued jobs deps have succeeded;
+        if any of them fails, key fails with DependencyError'''
+        self.deps.setdefault(key, set()).update(deps)
+
+    def limit(self, key, group, maxJobs):
+        'count job key against group, of which at most maxJobs may run at once'
+        self.groups.setdefault(key, set()).add(group)
+        self.groupLimits[group] = maxJobs
+
+    def count_job(self, job, n):
+        'add n to the running job counts of the zpools and groups of job'
+        for counts, pools in zip((self.srcCounts, self.destCounts), job[3]):
+            for pool in pools:
+                counts[pool] = counts.get(pool, 0) + n
+        for group in self.groups.get(job[0], ()):
+            self.groupCounts[group] = self.groupCounts.get(group, 0) + n
+
+    def sort_jobs(self, sizes):
+        'start the largest jobs first, given dict of {key:size}'
+        self.jobs.sort(key=lambda job:-sizes.get(job[0], 0))
+
+    def is_ready(self, job):
+        'are all the filesystems, zpools and dependencies of job available?'
+        if job[2] & self.busyFS or not self.deps.get(job[0], set()) <= self.succeeded:
+            return False
+        for pool in job[3][0]:
+            if self.srcCounts.get(pool, 0) >= self.srcPoolJobs:
+                return False
+        for pool in job[3][1]:
+            if self.destCounts.get(pool, 0) >= self.destPoolJobs:
+                return False
+        for group in self.groups.get(job[0], ()):
+            if self.groupCounts.get(group, 0) >= self.groupLimits[group]:
+                return False
+        return True
+
+    def next_job(self):
+        'wait for a queued job that can start now, or None if queue empty'
+        with self.cond:
+            while self.jobs:
+                for i, job in enumerate(self.jobs):
+                    failed = self.deps.get(job[0], set()) & self.failed
+                    if failed: # can never run, so fail it too
+                        del self.jobs[i]
+                        self.failed.add(job[0])
+                        self.results.append((job[0], None, DependencyError(
+                            'skipped because %s failed'
+                            % ', '.join(sorted([format_job_key(k) for k in failed])))))
+                        self.cond.notify_all()
+                        break
+                    if self.is_ready(job):
+                        del self.jobs[i]
+                        self.busyFS.update(job[2])
+                        self.count_job(job, 1)
+                        return job
+                else:
+                    self.cond.wait()
+
+    def finish_job(self, job, result, error):
+        'release the resources of job and record its outcome'
+        with self.cond:
+            self.busyFS.difference_update(job[2])
+            self.count_job(job, -1)
+            if error is None:
+                self.succeeded.add(job[0])
+            else:
+                self.failed.add(job[0])
+            self.results.append((job[0], result, error))
+            self.cond.notify_all()
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                result, error = job[1](*job[4], **job[5]), None
+            except Exception as e:
+                result, error = None, e
+            self.finish_job(job, result, error)
+
+    def run(self):
+        'run all queued jobs, returning list of (key, result, error)'
+        threads = [threading.Thread(target=self.worker)
+                   for i in range(min(self.nworkers, len(self.jobs)))]
+        for t in threads:
+            t.daemon = True # do not block Ctrl-C exit
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(1) # timeout keeps main thread responsive to Ctrl-C
+        return self.results
+
+def describe_error(e):
+    'get message explaining why a sync job failed'
+    if isinstance(e, CannotFastForwardError):
+        return 'cannot fast-forward either side.  Recursive merge not yet supported!'
+    elif isinstance(e, DependencyError):
+        return str(e)
+    elif isinstance(e, ZfsReceiveError):
+        return 'zfs receive failed, sync skipped.  Consider using --readonly option'
+    elif isinstance(e, subprocess.CalledProcessError):
+        cmd = e.cmd
+        if not isinstance(cmd, basestring):
+            cmd = ' '.join(cmd)
+        return 'command failed with status %d: %s' % (e.returncode, cmd)
+    return '%s: %s' % (e.__class__.__name__, e)
+
+def report_failures(results):
+    'print failed jobs from TransferScheduler.run() results; return status'
+    status = 0
+    for key, result, error in results:
+        if error is not None:
+            print 'ERROR: %s: %s' % (format_job_key(key), describe_error(error))
+            status = 1
+    return status
+
+
+##########################################################################
+# transfer size estimation
+
+def parse_send_estimate(output):
+    'get (bytes, toname) from zfs send -nvP output; toname only for resume tokens'
+    nbytes, toname = 0, None
+    for line in output.split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == 'size':
+            nbytes = int(fields[1])
+        elif len(fields) == 3 and fields[:2] == ['toname', '=']:
+            toname = fields[2]
+    return nbytes, toname
+
+def get_send_size(src, snap, fromsnap=None, cmd=['zfs', 'send', '-nvP']):
+    '''estimate bytes of zfs send of src@snap, including all snapshots
+    since fromsnap if given, without sending anything'''
+    if fromsnap:
+        cmd = cmd + ['-I', '@' + fromsnap]
+    return parse_send_estimate(check_output(zfs_cmd(cmd, src + '@' + snap)))[0]
+
+def estimate_ff(src, dest, snapshotDict, createIfMissing=False,
+                cmd=['zfs', 'send', '-nvP']):
+    '''estimate bytes that update_dest(src, dest) would send, or None if
+    dest cannot be fast-forwarded from src'''
+    srcSnaps = get_snaps(snapshotDict, src)
+    token = getattr(snapshotDict, 'resumeTokens', {}).get(dest)
+    nbytes = 0
+    if token: # rest of the interrupted stream, then the usual fast-forward
+        nbytes, toname = parse_send_estimate(check_output(
+            host_cmd(split_host(src)[0], cmd + ['-t', token])))
+        try:
+            start = srcSnaps.find(toname.split('@')[1])
+        except (AttributeError, KeyError): # not a snapshot of src
+            return nbytes
+    elif dest not in snapshotDict:
+        if not (createIfMissing and dest_zpool_exists(dest, snapshotDict)):
+            return 0 # dest not available, so nothing will be sent
+        nbytes, start = get_send_size(src, srcSnaps.names[0]), 0
+    else:
+        try:
+            start = srcSnaps.find_guid(get_snaps(snapshotDict, dest).guids[-1])
+        except (IndexError, KeyError): # HEAD of dest not in src
+            return None
+    if start < len(srcSnaps) - 1: # push_ff() sends the same data with -I or -i
+        nbytes += get_send_size(src, srcSnaps.names[-1], srcSnaps.names[start])
+    return nbytes
+
+def plan_sync(src, dest, snapshotDict, createIfMissing=False):
+    '''estimate the transfer that sync_ff(src, dest) would make, as
+    (sender, receiver, bytes)'''
+    nbytes = estimate_ff(src, dest, snapshotDict, createIfMissing)
+    if nbytes is not None:
+        return src, dest, nbytes
+    nbytes = estimate_ff(dest, src, snapshotDict, createIfMissing)
+    if nbytes is not None:
+        return dest, src, nbytes
+    raise CannotFastForwardError('cannot fast-forward either %s or %s' % (src, dest))
+
+def format_duration(seconds):
+    'get H:MM:SS string'
+    seconds = int(seconds + 0.5)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def plan_transfers(backupMap, snapshotDict, createIfMissing=False, jobs=4,
+                   poolJobs=(4, 1), rate=None):
+    '''estimate every sync in backupMap (in parallel, since zfs send -n only
+    reads metadata) and print the plan, largest first, with bytes per
+    destination pool and ETA at rate bytes/sec per transfer.
+    Return list of (key, sender, receiver, bytes), largest first'''
+    if rate is None:
+        rate = read_json_config().get('transferRate', TRANSFER_RATE)
+    estimator = TransferScheduler(jobs, jobs, jobs)
+    for src, dests in backupMap.items():
+        for t in dests:
+            estimator.add((src, t[1]), plan_sync, (src, t[1]), src, t[1],
+                          snapshotDict, createIfMissing)
+    plan = []
+    for key, result, error in estimator.run():
+        if error is not None:
+            print 'WARNING: cannot estimate %s: %s' % (format_job_key(key),
+                                                        describe_error(error))
+        elif result[2]:
+            plan.append((key,) + result)
+    plan.sort(key=lambda t:-t[3])
+    poolBytes = {}
+    srcBytes = {}
+    for key, sender, receiver, nbytes in plan:
+        print '%10s  %s --> %s' % (format_bytes(nbytes), sender, receiver)
+        pool = zfs_pool(receiver)
+        poolBytes[pool] = poolBytes.get(pool, 0) + nbytes
+        srcBytes[zfs_pool(sender)] = srcBytes.get(zfs_pool(sender), 0) + nbytes
+    for pool in sorted(poolBytes):
+        print '%10s  to pool %s' % (format_bytes(poolBytes[pool]), pool)
+    total = sum(poolBytes.values())
+    seconds = max([total / float(rate * jobs)] + # all workers busy
+                  [nbytes / float(rate * poolJobs[0]) for nbytes in srcBytes.values()]
+                  + [nbytes / float(rate * poolJobs[1]) for nbytes in poolBytes.values()]
+                  + [t[3] / float(rate) for t in plan[:1]]) # largest transfer
+    print 'plan: %d transfers, %s in total, estimated time %s at %s/sec per transfer' \
+          % (len(plan), format_bytes(total), format_duration(seconds),
+             format_bytes(rate))
+    return plan
 
 
 ##########################################################################
@@ -490,8 +2120,25 @@ def get_remote_add_args():
     parser.add_argument('zfsname', help='ZFS file system name')
     parser.add_argument('--defer', action='store_true', help='do not actually create remote filesystem at this time')
     parser.add_argument('--readonly', action='store_true', help='mark remote as readonly archive')
+    parser.add_argument('--per-snapshot', action='store_true',
+                        help='push one stream per snapshot instead of a single zfs send -I stream')
+    parser.add_argument('--buffer-size', type=int,
+                        help='MB of send stream to buffer in memory (default %d)'
+                        % (TRANSFER_BUFFER // 1024 // 1024))
+    add_send_flag_args(parser)
     return parser.parse_args()
 
+def add_send_flag_args(parser):
+    'add options for zfs send stream flags'
+    parser.add_argument('-c', '--compressed', dest='sendFlags', action='append_const',
+                        const='-c', help='send blocks compressed as stored on disk')
+    parser.add_argument('-L', '--large-block', dest='sendFlags', action='append_const',
+                        const='-L', help='send blocks larger than 128K intact')
+    parser.add_argument('-e', '--embed', dest='sendFlags', action='append_const',
+                        const='-e', help='send embedded data blocks as-is')
+    parser.add_argument('-w', '--raw', dest='sendFlags', action='append_const',
+                        const='-w', help='send encrypted data raw, without decrypting')
+
 def get_remote_remove_args():
     parser = get_remote_parser()
     parser.add_argument('remote', help='name of remote to delete')
@@ -500,23 +2147,30 @@ def get_remote_remove_args():
 def do_remote_add(src, backupMap):
     'zgit remote add command'
     args = get_remote_add_args()
+    remoteOpts = {}
+    if args.per_snapshot:
+        remoteOpts['intermediate'] = False
+    if args.buffer_size:
+        remoteOpts['bufferSize'] = args.buffer_size * 1024 * 1024
+    if args.sendFlags:
+        remoteOpts['sendFlags'] = args.sendFlags
     add_backup_mapping(src, args.zfsname, args.remote, backupMap,
-                       deferPush=args.defer, readonly=args.readonly)
-    write_json_map(backupMap)
+                       deferPush=args.defer, readonly=args.readonly,
+                       remoteOpts=remoteOpts)
+    save_remote(src, backupMap[src][-1])
     
 def do_remote_remove(src, backupMap):
     'zgit remote remove command'
     args = get_remote_remove_args()
-    rm_backup_mapping(src, None, remote=args.remote, backupMap=backupMap)
-    write_json_map(backupMap)
+    save_remote_removal(src, None, remote=args.remote)
 
 def list_remotes(src=None):
     'list name of remote and zfs path'
     backupMap = read_json_map()
     if not src:
         src = get_zfs_name()
-    for remote, dest in backupMap.get(src, ()):
-        print remote, dest
+    for t in backupMap.get(src, ()):
+        print t[0], t[1]
 
     
 def remote_cmd():
@@ -534,6 +2188,47 @@ def remote_cmd():
               remove REMOTENAME'''
         return 1 # error status
 
+#######################################################################
+# resume command
+
+def get_resume_args():
+    parser = get_base_parser()
+    parser.add_argument('zfsnames', nargs='*',
+                        help='filesystem(s) with partial receive state (default: all)')
+    parser.add_argument('--list', action='store_true',
+                        help='list partial receive state without resuming')
+    parser.add_argument('--abort', nargs='+', metavar='ZFSNAME',
+                        help='discard partial receive state of filesystem(s)')
+    return parser.parse_args()
+
+def resume_cmd():
+    'resume, list or discard interrupted zfs receives'
+    args = get_resume_args()
+    backupMap = read_json_map()
+    snapshotDict = get_snapshot_dict(hosts=get_map_hosts(backupMap))
+    tokens = snapshotDict.resumeTokens
+    partners = {} # other side of each backupMap pair, to send from
+    for src, dests in backupMap.items():
+        for t in dests:
+            partners[src] = t[1]
+            partners[t[1]] = src
+    status = 0
+    for dest in args.abort or args.zfsnames or sorted(tokens):
+        if dest not in tokens:
+            print '%s has no partial receive state' % dest
+            status = 1
+        elif args.list:
+            print '%s\treceiving %s' % (dest, get_resume_toname(tokens[dest]))
+        elif args.abort:
+            abort_receive(dest, snapshotDict)
+            print 'discarded partial receive state of %s' % dest
+        else:
+            snap = resume_receive(dest, snapshotDict, partners.get(dest),
+                                  discard=False)
+            print 'resumed %s@%s' % (dest, snap)
+    return status
+
+
 #######################################################################
 # map command
 
@@ -556,8 +2251,8 @@ def count_divergences(src, dest, snapshotDict):
 
 def is_remote_dest(src, dest, backupMap):
     'is dest a zgit remote of src?'
-    for remote, path in backupMap.get(src, ()):
-        if path == dest:
+    for t in backupMap.get(src, ()):
+        if t[1] == dest:
             return True
         
 def get_map_args():
@@ -567,25 +2262,27 @@ def get_map_args():
                         help='comma separated list of ZFS pools to prefer as reference')
     return parser.parse_args()
 
-def add_new_mapping(src, dest, backupMap):
+def add_new_mapping(src, dest, backupMap, snapshotDict=None):
     'add pair to backup mapping, init if needed'
     if src not in backupMap:
         do_init(src, backupMap)
     remoteName = dest.split('/')[0]
-    add_backup_mapping(src, dest, remoteName, backupMap)
-    write_json_map(backupMap)
+    add_backup_mapping(src, dest, remoteName, backupMap, snapshotDict)
+    save_remote(src, backupMap[src][-1])
 
 def map_cmd():
     'print ZFS content mappings based on snapshot GUIDs intersection'
     args = get_map_args()
     sourceOrder = args.order.split(',')
-    backupMap = read_json_map()
-    snapshotDict = get_snapshot_dict()
-    snapshotMap = get_snapshot_map(snapshotDict, backupMap, sourceOrder)
+    configDict = read_json_config()
+    backupMap = configDict['backupMap']
+    snapshotDict = load_inventory(get_map_hosts(backupMap), configDict)
+    lineage = SnapshotLineage(snapshotDict)
+    snapshotMap = lineage.get_pairs(backupMap, sourceOrder)
     mapData = snapshotMap.items()
     mapData.sort(lambda x,y:cmp(len(y[1]), len(x[1]))) # sort longest first
     for pair, snaps in mapData:
-        i, j = count_divergences(pair[0], pair[1], snapshotDict)
+        i, j = lineage.count_divergences(pair[0], pair[1])
         if i:
             print '%s is ahead of %s by %d commits' % (pair[0], pair[1], i)
         if j:
@@ -593,37 +2290,189 @@ def map_cmd():
         elif i == 0:
             print '%s and %s are in sync (%d shared commits)' \
               % (pair[0], pair[1], len(snaps))
+        for fs in pair:
+            if fs in snapshotDict.offline:
+                print '\t(%s is offline: showing its last-known state)' % fs
         if not is_remote_dest(pair[0], pair[1], backupMap):
             print '\tNOT yet added as a zgit remote: you can use "zgit remote add" to do so.\n'
             if args.add:
                 doAdd = raw_input('Type Y to add now: ')
                 if doAdd and doAdd.lower()[0] == 'y':
-                    add_new_mapping(pair[0], pair[1], backupMap)
+                    add_new_mapping(pair[0], pair[1], backupMap, snapshotDict)
 
 
 ############################################################################
 # forget command
 
-def forget_snapshots(src, snapshotDict, keep=4):
-    'delete old snapshots keeping only most recent snapshot(s) specified by keep'
-    deleteSnaps = snapshotDict[src][:-keep]
-    if deleteSnaps:
-        print 'deleting %d old snapshots from %s...' % (len(deleteSnaps), src)
-    for snapInfo in deleteSnaps:
-        destroy_snapshot(src, snapInfo[0])
+RETENTION_PERIODS = ( # period name, and key of its time bucket
+    ('hourly', lambda dt:(dt.date(), dt.hour)),
+    ('daily', lambda dt:dt.date()),
+    ('weekly', lambda dt:dt.isocalendar()[:2]),
+    ('monthly', lambda dt:(dt.year, dt.month)),
+    ('yearly', lambda dt:dt.year))
+
+def get_retention_policy(fs, configDict):
+    '''get retention policy dict for fs, e.g. {"latest":4, "daily":7,
+    "weekly":4, "monthly":12}, from MAPPATH "retention" by filesystem
+    name or its "default" entry; None if there is none'''
+    policies = configDict.get('retention', {})
+    return policies.get(fs, policies.get('default'))
+
+def select_retained(snaps, policy):
+    '''get set of indexes of snaps kept by grandfather-father-son policy:
+    the newest snapshot in each of the latest N hours, days, weeks, months
+    and years given by policy, plus its "latest" N snapshots'''
+    keep = set(range(max(len(snaps) - policy.get('latest', 1), 0), len(snaps)))
+    creations = snaps.creations
+    for period, get_bucket in RETENTION_PERIODS:
+        buckets = set()
+        for i in range(len(snaps) - 1, -1, -1):
+            if len(buckets) >= policy.get(period, 0):
+                break
+            bucket = get_bucket(datetime.datetime.fromtimestamp(creations[i]))
+            if bucket not in buckets: # newest snapshot of this bucket
+                buckets.add(bucket)
+                keep.add(i)
+    return keep
+
+def get_partners(fs, backupMap):
+    'get list of all filesystems that fs syncs with according to backupMap'
+    partners = [t[1] for t in backupMap.get(fs, ())]
+    for src, dests in backupMap.items():
+        if fs in [t[1] for t in dests]:
+            partners.append(src)
+    return partners
+
+def find_sync_base(src, dest, snapshotDict):
+    '''get index in src of the newest snapshot it shares with dest (as in
+    count_divergences), or None if they share none'''
+    srcSnaps, destSnaps = get_snaps(snapshotDict, src), get_snaps(snapshotDict, dest)
+    for i in range(len(srcSnaps) - 1, -1, -1):
+        try:
+            destSnaps.find_guid(srcSnaps.guids[i])
+            return i
+        except KeyError:
+            pass
+
+def plan_retention(fs, snapshotDict, backupMap, keep=4, policy=None):
+    '''get names of snapshots of fs to delete, keeping the latest keep
+    (or those selected by retention policy) and always the newest
+    snapshot shared with each of its remotes, so that no sync with them
+    needs a full resend.  Raise ValueError if a remote is unavailable'''
+    snaps = get_snaps(snapshotDict, fs)
+    if policy:
+        retained = select_retained(snaps, policy)
+    elif keep > 0:
+        retained = set(range(max(len(snaps) - keep, 0), len(snaps)))
+    else: # keep everything
+        return []
+    for partner in get_partners(fs, backupMap):
+        if partner in snapshotDict:
+            base = find_sync_base(fs, partner, snapshotDict)
+            if base is not None:
+                retained.add(base)
+        elif not dest_zpool_exists(partner, snapshotDict):
+            raise ValueError('%s is not available, so cannot tell which snapshots it needs'
+                             % partner)
+    return [snap for i, snap in enumerate(snaps.names) if i not in retained]
+
+def get_retention_inventory(srcs, backupMap, configDict=None):
+    '''get inventory of srcs and all their remotes, using the snapshot
+    catalog's last-known state for remotes that are offline'''
+    if configDict is None:
+        configDict = read_json_config()
+    partners = set()
+    for src in srcs:
+        partners.update(get_partners(src, backupMap))
+    snapshotDict = get_scoped_snapshot_dict(list(srcs) + list(partners))
+    missing = [fs for fs in partners if fs not in snapshotDict
+               and not dest_zpool_exists(fs, snapshotDict)]
+    path = configDict.get('catalog', CATALOGPATH)
+    if missing and path and os.path.exists(os.path.expanduser(path)):
+        catalog = SnapshotCatalog(path)
+        try:
+            known = catalog.get_inventory(get_hosts(missing))
+        finally:
+            catalog.close()
+        for fs in missing:
+            if fs in known:
+                snapshotDict[fs] = known[fs]
+                snapshotDict.offline.add(fs)
+    return snapshotDict
+
+def forget_snapshots(src, snapshotDict, keep=4, dryRun=False, backupMap=None,
+                     policy=None):
+    '''delete old snapshots keeping only most recent snapshot(s) specified by
+    keep, or by retention policy, plus the sync base of each remote.
+    Return the number of bytes reclaimed'''
+    if backupMap is None:
+        backupMap = read_json_map()
+    deleteSnaps = plan_retention(src, snapshotDict, backupMap, keep, policy)
+    if not deleteSnaps:
+        return 0
+    reclaim = destroy_snapshots(src, deleteSnaps, snapshotDict=snapshotDict,
+                                dryRun=dryRun)
+    print '%s %d old snapshots from %s, reclaiming %s' \
+      % (dryRun and 'would delete' or 'deleted', len(deleteSnaps), src,
+         format_bytes(reclaim))
+    return reclaim
 
 def get_forget_args():
     parser = get_base_parser()
     parser.add_argument('--keep', type=int, help='number of latest commits to keep', default=4)
+    parser.add_argument('--all', action='store_true',
+                        help='forget old commits of all zgit-registered filesystems')
+    parser.add_argument('--policy', action='store_true',
+                        help='keep commits selected by the retention policy in %s' % MAPPATH)
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only report what would be deleted, and space reclaimed')
+    add_jobs_args(parser)
     return parser.parse_args()
 
+def get_policy_arg(src, configDict, usePolicy):
+    'get retention policy of src if usePolicy, or raise ValueError if it has none'
+    if not usePolicy:
+        return None
+    policy = get_retention_policy(src, configDict)
+    if not policy:
+        raise ValueError('no retention policy for %s in %s' % (src, MAPPATH))
+    return policy
+
+def forget_all(keep=4, dryRun=False, jobs=4, poolJobs=1, usePolicy=False):
+    'forget old commits of all sources in backup map, pools in parallel'
+    configDict = read_json_config()
+    backupMap = configDict['backupMap']
+    snapshotDict = get_retention_inventory(list(backupMap), backupMap, configDict)
+    scheduler = TransferScheduler(jobs, destPoolJobs=poolJobs)
+    for src in backupMap:
+        policy = get_policy_arg(src, configDict, usePolicy)
+        if src in snapshotDict:
+            scheduler.add(src, forget_snapshots, [src], src, snapshotDict,
+                          keep, dryRun, backupMap, policy)
+    results = scheduler.run()
+    status = report_failures(results)
+    reclaim = sum([t[1] for t in results if t[1]])
+    print 'total: %s %s' % (dryRun and 'would reclaim' or 'reclaimed',
+                            format_bytes(reclaim))
+    return status
 
 def forget_cmd():
     'delete all but most recent snapshots in current ZFS filesystem'
     args = get_forget_args()
-    snapshotDict = get_snapshot_dict()
-    src = get_zfs_name()
-    forget_snapshots(src, snapshotDict, args.keep)
+    try:
+        if args.all:
+            return forget_all(args.keep, args.dry_run, args.jobs, get_pool_jobs(args)[1],
+                              args.policy)
+        configDict = read_json_config()
+        src = get_zfs_name()
+        policy = get_policy_arg(src, configDict, args.policy)
+        snapshotDict = get_retention_inventory([src], configDict['backupMap'],
+                                               configDict)
+        forget_snapshots(src, snapshotDict, args.keep, args.dry_run,
+                         configDict['backupMap'], policy)
+    except ValueError, e:
+        print 'ERROR: %s' % e
+        return 1
     return 0
 
 
@@ -644,44 +2493,115 @@ def get_clone_args():
                         help='ZFS path to clone')
     cloneP.add_argument('dest', nargs='?', default='//',
                         help='path to create new clone')
+    add_send_flag_args(cloneP)
+    add_jobs_args(cloneP, poolJobs=4)
     return parser.parse_args()
 
 def clone_cmd():
     'clone one or more ZFS repos'
     args = get_clone_args()
     backupMap = read_json_map()
-    snapshotDict = get_snapshot_dict()
+    snapshotDict = get_snapshot_dict(hosts=get_map_hosts(backupMap) |
+                        get_hosts((args.many or []) + [args.origin or '', args.dest]))
+    remoteOpts = {}
+    if args.sendFlags:
+        remoteOpts['sendFlags'] = args.sendFlags
+    status = 0
     if args.all:
-        clone_all(args.origin, backupMap, snapshotDict, args.keep)
+        status = clone_all(args.origin, backupMap, snapshotDict, args.keep,
+                           remoteOpts, args.jobs, get_pool_jobs(args))
     elif args.many:
         for src in args.many:
-            do_clone(src, args.dest, backupMap, snapshotDict, args.keep)
+            do_clone(src, args.dest, backupMap, snapshotDict, args.keep,
+                     remoteOpts=remoteOpts)
     elif args.origin:
-        do_clone(args.origin, args.dest, backupMap, snapshotDict, args.keep)
+        do_clone(args.origin, args.dest, backupMap, snapshotDict, args.keep,
+                 remoteOpts=remoteOpts)
     else:
         raise ValueError('You must supply a ZFS path as origin or --many or --all')
-    write_json_map(backupMap)
-    return 0
+    return status
 
-def do_clone(src, dest, backupMap, snapshotDict, keep=0, remoteName='origin'):
+def do_clone(src, dest, backupMap, snapshotDict, keep=0, remoteName='origin',
+             remoteOpts=None):
     'clone a ZFS repo and record it as origin of new copy'
+    if remoteOpts is None:
+        remoteOpts = {}
     if dest == '//': # default to basename of origin
         dest = get_zfs_name() + '/' + src.split('/')[-1]
-    clone_initial_snapshot(src, dest, snapshotDict, -keep) # pull first snapshot
-    update_dest(src, dest, snapshotDict) # update to match src HEAD
-    add_backup_mapping(dest, src, remoteName, backupMap) # add src as origin of dest
+    clone_from(src, dest, snapshotDict, keep, remoteOpts)
+    add_backup_mapping(dest, src, remoteName, backupMap, snapshotDict,
+                       remoteOpts=remoteOpts) # add src as origin of dest
+    save_remote(dest, backupMap[dest][-1])
     
-def clone_all(origin, backupMap, snapshotDict, keep=0):
-    'clone all available ZFS repos registered in backupMap, filtered by origin if given'
-    targets = list(backupMap)
-    targets.sort() # ensure parent filesystems before children
-    for target in targets:
+def clone_from(src, dest, snapshotDict, keep=0, remoteOpts=None):
+    'create dest from the latest keep commits of src (or all if 0)'
+    if remoteOpts is None:
+        remoteOpts = {}
+    clone_initial_snapshot(src, dest, snapshotDict, -keep,
+                           sendFlags=remoteOpts.get('sendFlags', ())) # pull first snapshot
+    return update_dest(src, dest, snapshotDict,
+                       remoteOpts=remoteOpts) # update to match src HEAD
+
+def estimate_clone(src, snapshotDict, keep=0):
+    'estimate bytes that clone_from(src, ...) would send'
+    snaps = get_snaps(snapshotDict, src)
+    first = snaps.names[-keep]
+    try:
+        nbytes = get_send_size(src, first)
+        if first != snaps.names[-1]:
+            nbytes += get_send_size(src, snaps.names[-1], first)
+    except subprocess.CalledProcessError:
+        print 'WARNING: cannot estimate size of %s' % src
+        return 0
+    return nbytes
+
+def get_clone_parent(target, clones):
+    'get the closest ancestor of target that is also being cloned, or None'
+    l = target.split('/')
+    for end in range(len(l) - 1, 1, -1):
+        parent = '/'.join(l[:end])
+        if parent in clones:
+            return parent
+
+def clone_all(origin, backupMap, snapshotDict, keep=0, remoteOpts=None,
+              jobs=4, poolJobs=(4, 4)):
+    '''clone all available ZFS repos registered in backupMap, filtered by
+    origin if given.  Clones run in parallel, each waiting only for the
+    clone of its parent filesystem (if any), starting with the subtrees
+    that have the most data to send.  Return status'''
+    clones = {}
+    for target in backupMap:
         if dest_zpool_exists(target, snapshotDict) and target not in snapshotDict: # could create target
-            for name, src in backupMap[target]:
+            for t in backupMap[target]:
+                src = t[1]
                 if (not origin or src.startswith(origin)) and snapshotDict.get(src): # available and has at least one snapshot
-                    clone_initial_snapshot(src, target, snapshotDict, -keep) # pull first snapshot
-                    update_dest(src, target, snapshotDict) # update to match src HEAD
+                    opts = dict(remote_options(t))
+                    opts.update(remoteOpts or {}) # command line overrides
+                    clones[target] = (src, opts)
                     break # success, so stop searching
+    set_phase('plan')
+    scheduler = TransferScheduler(jobs, *poolJobs)
+    sizes = {}
+    total = 0
+    for target in sorted(clones, reverse=True): # children before parents
+        src, opts = clones[target]
+        nbytes = estimate_clone(src, snapshotDict, keep)
+        total += nbytes
+        # most data left to send from here along any path down its subtree
+        sizes[target] = sizes.get(target, 0) + nbytes
+        parent = get_clone_parent(target, clones)
+        if parent: # clone of target can only start after its parent's
+            scheduler.require(target, [parent])
+            sizes[parent] = max(sizes.get(parent, 0), sizes[target])
+        else: # create parents up front, since no clone creates them
+            create_missing_parents(target, snapshotDict)
+        scheduler.add(target, clone_from, (src, target), src, target,
+                      snapshotDict, keep, opts)
+    if clones:
+        print 'cloning %d filesystems (%s)...' % (len(clones), format_bytes(total))
+    scheduler.sort_jobs(sizes)
+    set_phase('transfers')
+    return report_failures(scheduler.run())
 
 ########################################################################
 # log command
@@ -691,13 +2611,14 @@ Author: %(author)s
 Date:   %(creation)s
 
     %(commitMsg)s
-'''):
+''', dateFormat='%a %b %d %H:%M:%S %Y'):
     'print git-style log of commits'
     src = get_zfs_name()
-    snapshotDict = get_snapshot_dict()
+    snapshotDict = get_scoped_snapshot_dict([src])
     snaps = snapshotDict[src]
     for i in range(len(snaps) - 1, -1, -1):
         snap, guid, creation, commitMsg = snaps[i]
+        creation = datetime.datetime.fromtimestamp(creation).strftime(dateFormat)
         print fmt % dict(snap=snap, guid=guid, creation=creation,
                          author='(not recorded)', commitMsg=commitMsg)
     return 0
@@ -709,6 +2630,8 @@ Date:   %(creation)s
 def get_commit_args():
     parser = get_base_parser()
     parser.add_argument('-m', '--message', help='commit message')
+    parser.add_argument('--all', action='store_true',
+                        help='commit all changed zgit-registered filesystems at once')
     return parser.parse_args()
 
 def commit_cmd():
@@ -717,10 +2640,254 @@ def commit_cmd():
     commitMsg = args.message
     if not commitMsg:
         commitMsg = raw_input('Enter a commit message: ')
+    if args.all:
+        backupMap = read_json_map()
+        if not commit_changed(backupMap, commitMsg, written=get_written(backupMap)):
+            print 'nothing to commit'
+        return 0
     src = get_zfs_name()
     snap = create_snapshot(src, commitMsg=commitMsg)
     print 'Committed snapshot %s' % snap
 
+#########################################################
+# daemon command
+
+class WarmInventory(object):
+    '''snapshot inventory, mount table and config kept in memory by zgit
+    daemon for the commands it runs, refreshed after commands that change
+    them, when zpool events arrive, and at least every poll seconds'''
+    def __init__(self, poll=DAEMON_POLL):
+        self.poll = poll
+        self.changed = threading.Event()
+        self.configTime = None
+        self.snapshotDict = self.mountDict = None
+        self.refresh()
+
+    def covers(self, hosts):
+        'is the inventory of these hosts warm?'
+        return self.snapshotDict is not None and set(hosts) <= self.hosts
+
+    def get_config(self):
+        'get copy of config, rereading it if its file has changed'
+        path = os.path.expanduser(MAPPATH)
+        try:
+            st = os.stat(path)
+            mtime = (st.st_ino, st.st_mtime) # writers rename a new file into place
+        except OSError:
+            mtime = None
+        if mtime != self.configTime:
+            self.configDict = dict(backupMap={})
+            if mtime is not None:
+                with open(path) as ifile:
+                    self.configDict = json.load(ifile)
+            self.configTime = mtime
+        return copy.deepcopy(self.configDict)
+
+    def refresh(self):
+        'reread all inventories'
+        self.snapshotDict = self.mountDict = None # list afresh, not from memory
+        self.hosts = get_map_hosts(self.get_config()['backupMap'])
+        snapshotDict = get_snapshot_dict(hosts=self.hosts)
+        self.mountDict = get_mount_dict()
+        self.snapshotDict = snapshotDict
+
+    def watch_events(self, cmd=['zpool', 'events', '-f', '-H']):
+        'flag a refresh whenever a zpool event arrives'
+        try:
+            for line in iter_zfs_lines(cmd):
+                self.changed.set()
+        except (subprocess.CalledProcessError, OSError):
+            print >>sys.stderr, 'zgit daemon: cannot follow zpool events; polling only'
+
+    def run_refresher(self, commandLock):
+        'refresh after zpool events (gathered for a second) or poll timeout'
+        while True:
+            self.changed.wait(self.poll)
+            time.sleep(self.changed.is_set() and 1 or 0)
+            self.changed.clear()
+            with commandLock:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print >>sys.stderr, 'zgit daemon: refresh failed: %s' % describe_error(e)
+
+class DaemonOutput(object):
+    'file-like object sending text written to it to a zgit daemon client'
+    def __init__(self, ofile, stream):
+        self.ofile = ofile
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock: # worker threads may print at once
+            if self.ofile is None: # client went away; finish the command anyway
+                return
+            try:
+                self.ofile.write(json.dumps({self.stream:text}) + '\n')
+                self.ofile.flush()
+            except (socket.error, IOError):
+                self.ofile = None
+
+    def flush(self):
+        pass
+
+def run_daemon_command(argv, cwd, ofile):
+    'run zgit command argv from directory cwd, sending its output to ofile'
+    global zfsListCalls
+    streams = sys.argv, sys.stdout, sys.stderr
+    sys.argv = ['zgit'] + argv
+    sys.stdout, sys.stderr = DaemonOutput(ofile, 'out'), DaemonOutput(ofile, 'err')
+    transferBytes.clear()
+    del traceRecords[:]
+    del tracePhases[:]
+    zfsListCalls = 0
+    set_phase(argv and argv[0] or 'usage')
+    try:
+        os.chdir(cwd)
+        status = main()
+    except SystemExit as e: # e.g. argparse error
+        status = e.code
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    try:
+        report_trace(argv and argv[0] or 'usage')
+    finally:
+        sys.argv, sys.stdout, sys.stderr = streams
+        os.chdir('/')
+    return status
+
+def serve_client(conn, commandLock):
+    '''run the read-only command sent by one client, or flag a refresh
+    if the client says it changed something'''
+    ifile, ofile = conn.makefile('r'), conn.makefile('w')
+    try:
+        request = json.loads(ifile.readline())
+        argv = request.get('argv')
+        if request.get('changed'): # client ran a command that may change inventory
+            warmInventory.changed.set()
+            status = 0
+        elif not is_readonly(argv):
+            print >>ofile, json.dumps({'err': 'zgit daemon runs only read-only commands\n'})
+            status = 1
+        else:
+            with commandLock: # commands share sys.stdout and the cwd
+                status = run_daemon_command(argv, request['cwd'], ofile)
+        ofile.write(json.dumps(dict(status=status or 0)) + '\n')
+        ofile.flush()
+    except (socket.error, IOError, ValueError): # client went away
+        pass
+    finally:
+        ifile.close()
+        ofile.close()
+        conn.close()
+
+def get_daemon_args():
+    parser = get_base_parser()
+    parser.add_argument('--poll', type=int,
+                        help='seconds between inventory refreshes (default %d)' % DAEMON_POLL)
+    return parser.parse_args()
+
+def daemon_cmd(path=DAEMONPATH):
+    '''keep inventory warm in memory and run read-only zgit commands
+    forwarded by the zgit CLI over a Unix socket, one at a time'''
+    global warmInventory
+    args = get_daemon_args()
+    path = os.path.expanduser(path)
+    if os.path.exists(path):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+        except socket.error: # left by a daemon that died
+            os.unlink(path)
+        else:
+            raise ValueError('zgit daemon is already running on %s' % path)
+        finally:
+            conn.close()
+    poll = args.poll or read_json_config().get('daemon', {}).get('poll', DAEMON_POLL)
+    warmInventory = WarmInventory(poll)
+    commandLock = threading.Lock()
+    for target, targs in ((warmInventory.watch_events, ()),
+                          (warmInventory.run_refresher, (commandLock,))):
+        t = threading.Thread(target=target, args=targs)
+        t.daemon = True
+        t.start()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldUmask = os.umask(0077) # only root may connect
+    try:
+        server.bind(path)
+    finally:
+        os.umask(oldUmask)
+    server.listen(5)
+    print 'zgit daemon listening on %s' % path
+    sys.stdout.flush()
+    os.chdir('/')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn = server.accept()[0]
+            t = threading.Thread(target=serve_client, args=(conn, commandLock))
+            t.daemon = True
+            t.start()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        os.unlink(path)
+
+def forward_command(argv, path=DAEMONPATH):
+    '''run zgit command argv in zgit daemon, if it is running, copying its
+    output to ours.  Return its status, or None if there is no daemon'''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(os.path.expanduser(path))
+    except socket.error: # no daemon
+        conn.close()
+        return None
+    ifile, ofile = conn.makefile('r'), conn.makefile('w')
+    try:
+        ofile.write(json.dumps(dict(argv=argv, cwd=os.getcwd())) + '\n')
+        ofile.flush()
+        for line in ifile:
+            msg = json.loads(line)
+            if 'status' in msg:
+                return msg['status']
+            stream = 'out' in msg and sys.stdout or sys.stderr
+            stream.write(msg.get('out', msg.get('err')).encode('utf-8'))
+            stream.flush()
+    finally:
+        ifile.close()
+        ofile.close()
+        conn.close()
+    print >>sys.stderr, 'ERROR: zgit daemon exited during command'
+    return 1
+
+def notify_daemon(path=DAEMONPATH):
+    'tell zgit daemon, if it is running, to refresh its inventory'
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(os.path.expanduser(path))
+        conn.sendall(json.dumps(dict(changed=True)) + '\n')
+        conn.recv(4096) # its status reply
+    except socket.error: # no daemon
+        pass
+    finally:
+        conn.close()
+
+def is_readonly(argv):
+    '''is zgit command argv one that changes nothing and never prompts?
+    (map --add pushes to new backups and asks before adding them)'''
+    if not argv or argv[0] not in READONLY_COMMANDS:
+        return False
+    return argv[0] != 'map' or \
+        not [arg for arg in argv if len(arg) > 2 and '--add'.startswith(arg)] # or abbreviated
+
+def can_forward(argv):
+    '''can zgit command argv run in zgit daemon?  Only read-only commands
+    do, so they never wait behind a long backup or sync'''
+    return not os.environ.get('ZGIT_NO_DAEMON') and is_readonly(argv)
+
+
 #########################################################
 # top level command line handling
 
@@ -732,7 +2899,8 @@ def run_all(func=do_status, **kwargs):
             return status
     
             
-if __name__ == '__main__':
+def main():
+    'run the zgit command given by sys.argv, returning its status'
     if len(sys.argv) > 1 and sys.argv[1] == 'init':
         status = init_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'remote':
@@ -742,18 +2910,9 @@ if __name__ == '__main__':
     elif len(sys.argv) > 1 and sys.argv[1] == 'diff':
         status = diff_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'status':
-        if len(sys.argv) > 2 and sys.argv[2] == '--all':
-            status = run_all()
-        else:
-            status = status_cmd()
+        status = status_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'backup':
-        import lvmgit
-        configDict = read_json_config()
-        for lvPath in configDict.get('lvmMap', ()):
-            lvmgit.do_commit(lvPath, configDict=configDict) # snapshot LVM to ZFS
-        status = run_all(commit_if_changed)
-        status = run_all(do_syncs)
-        #backup_sources()
+        status = backup_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'map':
         status = map_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'clone':
@@ -763,14 +2922,13 @@ if __name__ == '__main__':
     elif len(sys.argv) > 1 and sys.argv[1] == 'commit':
         status = commit_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'sync':
-        args = get_sync_args()
-        if args.all:
-            status = run_all(do_syncs, createIfMissing=args.create, readonly=args.readonly)
-        else:
-            src, backupMap = get_backup_src()
-            status = do_syncs(src, backupMap[src], createIfMissing=args.create, readonly=args.readonly)
+        status = sync_cmd()
     elif len(sys.argv) > 1 and sys.argv[1] == 'forget':
         status = forget_cmd()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'resume':
+        status = resume_cmd()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        status = daemon_cmd()
     else:
         print '''Usage: zgit COMMAND [args] [options]
         where COMMAND is:
@@ -783,8 +2941,28 @@ if __name__ == '__main__':
               log: list commits in this repo
               commit: commit a snapshot of this ZFS file system
               map: find ZFS filesystems that share common commits
-              forget: delete old snapshots in this ZFS file system''' % MAPPATH
+              forget: delete old snapshots in this ZFS file system
+              resume: resume (or --list, --abort) interrupted receives
+              daemon: keep inventory in memory for faster zgit commands''' % MAPPATH
         status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.modules['zgit'] = sys.modules[__name__] # lvmgit shares this module's state
+    command = len(sys.argv) > 1 and sys.argv[1] or 'usage'
+    if can_forward(sys.argv[1:]):
+        status = forward_command(sys.argv[1:])
+        if status is not None: # daemon ran it
+            sys.exit(status)
+    set_phase(command)
+    status = main()
+    if os.environ.get('ZGIT_DEBUG'): # report inventory cost of this command
+        print >>sys.stderr, 'zgit: %d zfs list calls' % zfsListCalls
+    close_transports()
+    report_trace(command)
+    if not os.environ.get('ZGIT_NO_DAEMON') and not is_readonly(sys.argv[1:]) \
+       and command != 'daemon':
+        notify_daemon()
     if status:
         sys.exit(status)
         
@@ -0,0 +1,268 @@
+import zgit
+import fakezfs
+import argparse
+import random
+import time
+import sys
+import os
+import json
+import tempfile
+import shutil
+import subprocess
+import resource
+
+def make_inventory(nLineages=100, nReplicas=4, nSnaps=1000, seed=1):
+    '''make synthetic inventory of nLineages filesystems, each replicated
+    on nReplicas pools with a random window of its nSnaps commits, plus a
+    few commits of its own'''
+    rand = random.Random(seed)
+    snapshotDict = {}
+    backupMap = {}
+    for i in range(nLineages):
+        history = [('s%05d' % k, str(rand.getrandbits(63)), 'now', None)
+                   for k in range(nSnaps)]
+        for r in range(nReplicas):
+            fs = 'pool%d/fs%d' % (r, i)
+            start = rand.randint(0, nSnaps // 2)
+            stop = rand.randint(start + 1, nSnaps)
+            snaps = history[start:stop]
+            for k in range(rand.randint(0, 3)): # diverged commits
+                snaps.append(('x%d' % k, str(rand.getrandbits(63)), 'now', None))
+            snapshotDict[fs] = snaps
+            if r > 0:
+                backupMap.setdefault('pool0/fs%d' % i, []).append(['backup', fs])
+    return snapshotDict, backupMap
+
+def map_functions(snapshotDict, backupMap, sourceOrder=()):
+    'pairs and divergences using get_snapshot_map() and count_divergences()'
+    snapshotMap = get_snapshot_map(snapshotDict, backupMap, sourceOrder)
+    return dict([(pair, (len(guids), count_divergences(pair[0], pair[1], snapshotDict)))
+                 for pair, guids in snapshotMap.items()])
+
+def map_lineage(snapshotDict, backupMap, sourceOrder=()):
+    'pairs and divergences using SnapshotLineage'
+    lineage = zgit.SnapshotLineage(snapshotDict)
+    return dict([(pair, (len(guids), lineage.count_divergences(pair[0], pair[1])))
+                 for pair, guids in lineage.get_pairs(backupMap, sourceOrder).items()])
+
+get_snapshot_map = zgit.get_snapshot_map
+count_divergences = zgit.count_divergences
+
+def build_tuples(lines):
+    'inventory as dict of lists of string tuples, as zfs list gives them'
+    d = {}
+    for line in lines:
+        name, guid, creation, commitMsg = line.split('\t')
+        fs, snap = name.split('@')
+        d.setdefault(fs, []).append((snap, guid, creation, commitMsg))
+    return d
+
+def build_compact(lines):
+    'inventory as SnapshotInventory of SnapshotList columns'
+    d = zgit.SnapshotInventory()
+    for line in lines:
+        name, guid, creation, commitMsg = line.split('\t')
+        fs, snap = name.split('@')
+        d.setdefault(fs).append((snap, guid, int(creation), commitMsg))
+    return d
+
+def iter_list_lines(nLineages=100, nReplicas=4, nSnaps=1000, seed=1):
+    'generate zfs list -H -p style lines like those of make_inventory()'
+    rand = random.Random(seed)
+    for i in range(nLineages):
+        guids = [str(rand.getrandbits(63)) for k in range(nSnaps)]
+        for r in range(nReplicas):
+            start = rand.randint(0, nSnaps // 2)
+            for k in range(start, rand.randint(start + 1, nSnaps)):
+                yield 'pool%d/fs%d@s%05d\t%s\t1500000000\tbackup latest changes' \
+                      % (r, i, k, guids[k])
+
+def get_peak_rss():
+    '''get peak RSS (KB) of this process.  On Linux ru_maxrss survives
+    exec, so read this process image's own high-water mark if possible'''
+    try:
+        with open('/proc/self/status') as ifile:
+            for line in ifile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_memory(kind, args):
+    'print increase in peak RSS (KB) from building inventory of this kind'
+    lines = list(iter_list_lines(args.lineages, args.replicas, args.snaps, args.seed))
+    start = get_peak_rss()
+    d = dict(tuples=build_tuples, compact=build_compact)[kind](lines)
+    print get_peak_rss() - start
+
+def peak_memory(kind, args):
+    'get KB used by inventory of this kind, measured in a fresh process'
+    return int(subprocess.check_output([sys.executable, __file__,
+        '--lineages', str(args.lineages), '--replicas', str(args.replicas),
+        '--snaps', str(args.snaps), '--seed', str(args.seed),
+        '--memory-child', kind]))
+
+def time_it(func, *args):
+    'return (result, seconds) of func(*args)'
+    t = time.time()
+    result = func(*args)
+    return result, time.time() - t
+
+#########################################################################
+# command suite, run against a simulated zfs (see fakezfs.py)
+
+SUITE = (('map', ['map']),
+         ('plan', ['sync', '--all', '--dry-run']),
+         ('log', ['log']),
+         ('forget', ['forget', '--all', '--keep', '10', '--dry-run']),
+         ('backup', ['backup']))
+
+def setup_scale(workDir, pools, filesystems, snapshots):
+    '''create fake zfs model of this scale, zgit config and zfs commands in
+    workDir, and point this process's PATH, HOME etc. at them.  Return the
+    mountpoint of pool0/fs0'''
+    for subdir in ('bin', 'home', 'mnt'):
+        if not os.path.isdir(os.path.join(workDir, subdir)):
+            os.makedirs(os.path.join(workDir, subdir))
+    fakezfs.install(os.path.join(workDir, 'bin'))
+    statePath = os.path.join(workDir, 'state.json')
+    fakezfs.init_state(statePath, pools, filesystems, snapshots,
+                       mountRoot=os.path.join(workDir, 'mnt'))
+    with open(os.path.join(workDir, 'home', '.zgit_conf.json'), 'w') as ofile:
+        json.dump(dict(backupMap=fakezfs.get_backup_map(pools, filesystems),
+                       metrics=dict(summary=False)), ofile)
+    os.environ.update(FAKEZFS_STATE=statePath, HOME=os.path.join(workDir, 'home'),
+                      PATH=os.path.join(workDir, 'bin') + os.pathsep
+                      + os.environ.get('PATH', ''))
+    mountpoint = os.path.join(workDir, 'mnt', 'pool0', 'fs0')
+    if not os.path.isdir(mountpoint):
+        os.makedirs(mountpoint)
+    return mountpoint
+
+def reset_zgit():
+    'forget the state left in the zgit module by a previous command'
+    zgit.transferBytes.clear()
+    zgit.poolFeatures.clear()
+    del zgit.traceRecords[:]
+    del zgit.tracePhases[:]
+    zgit.zfsListCalls = 0
+
+def run_command(argv):
+    '''run zgit command argv in this process, with its output discarded.
+    Return dict of its status, wall time, CPU time used by zgit itself and
+    by its zfs commands, and number of zfs commands'''
+    reset_zgit()
+    zgit.set_phase(argv[0])
+    sys.argv = ['zgit'] + argv
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start, startTimes = time.time(), os.times()
+    try:
+        status = zgit.main() or 0
+    except Exception as e:
+        status = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        zgit.close_transports()
+    wall, endTimes = time.time() - start, os.times()
+    return dict(status=status, wall=wall,
+                cpu=sum(endTimes[:2]) - sum(startTimes[:2]),
+                zfsCpu=sum(endTimes[2:4]) - sum(startTimes[2:4]),
+                commands=len(zgit.traceRecords))
+
+def get_revision():
+    'get git revision of this zgit, or None'
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def read_results(path):
+    'get list of result dicts from earlier runs'
+    try:
+        with open(path) as ifile:
+            return [json.loads(line) for line in ifile]
+    except IOError:
+        return []
+
+def find_previous(results, scale, command):
+    'get the latest earlier result of command at this scale, or None'
+    for r in reversed(results):
+        if r['scale'] == scale and r['command'] == command:
+            return r
+
+def run_suite(scales, resultsPath, workDir=None):
+    '''time each command of SUITE at each scale (pools x filesystems x
+    snapshots), comparing with the previous run in resultsPath and
+    appending these results to it'''
+    tempDir = workDir is None
+    if tempDir:
+        workDir = tempfile.mkdtemp(prefix='zgitbench')
+    previous = read_results(resultsPath)
+    run = dict(run=time.strftime('%Y-%m-%dT%H:%M:%S'), revision=get_revision())
+    cwd = os.getcwd()
+    with open(resultsPath, 'a') as ofile:
+        for scale in scales:
+            pools, filesystems, snapshots = [int(x) for x in scale.split('x')]
+            print '%s: %d filesystems, %d snapshots' % (scale, pools * filesystems,
+                                                         pools * filesystems * snapshots)
+            os.chdir(setup_scale(os.path.join(workDir, scale), pools, filesystems,
+                                 snapshots)) # so log finds pool0/fs0
+            try:
+                for command, argv in SUITE:
+                    r = dict(run, scale=scale, command=command, **run_command(argv))
+                    ofile.write(json.dumps(r, sort_keys=True) + '\n')
+                    last = find_previous(previous, scale, command)
+                    print '  %-7s %8.2f sec  zgit cpu %7.2f  zfs cpu %7.2f  %5d zfs commands%s%s' \
+                          % (command, r['wall'], r['cpu'], r['zfsCpu'], r['commands'],
+                             last and '  %.2fx vs %s' % (r['wall'] / max(last['wall'], 1e-6),
+                                                         last['revision'] or last['run'])
+                             or '', r['status'] and '  FAILED: %s' % r['status'] or '')
+            finally:
+                os.chdir(cwd)
+    if tempDir:
+        shutil.rmtree(workDir)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark zgit map on synthetic inventories')
+    parser.add_argument('--lineages', type=int, default=100, help='number of related filesystem groups')
+    parser.add_argument('--replicas', type=int, default=4, help='filesystems per group')
+    parser.add_argument('--snaps', type=int, default=1000, help='commits per group')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--memory', action='store_true',
+                        help='also compare inventory memory use')
+    parser.add_argument('--memory-child', help=argparse.SUPPRESS)
+    parser.add_argument('--suite', action='store_true',
+                        help='instead time zgit commands against a simulated zfs')
+    parser.add_argument('--scales', default='2x10x100,2x100x100,2x100x1000',
+                        help='comma-separated POOLSxFILESYSTEMSxSNAPSHOTS for --suite')
+    parser.add_argument('--results', default='zgitbench.jsonl',
+                        help='file of --suite results, to compare and append to')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.memory_child:
+        measure_memory(args.memory_child, args)
+        sys.exit(0)
+    if args.suite:
+        run_suite(args.scales.split(','), args.results)
+        sys.exit(0)
+    snapshotDict, backupMap = make_inventory(args.lineages, args.replicas,
+                                             args.snaps, args.seed)
+    print '%d filesystems, %d snapshots' % (len(snapshotDict),
+                        sum([len(snaps) for snaps in snapshotDict.values()]))
+    old, oldTime = time_it(map_functions, snapshotDict, backupMap, ('pool1',))
+    new, newTime = time_it(map_lineage, snapshotDict, backupMap, ('pool1',))
+    print 'get_snapshot_map + count_divergences: %.3f sec' % oldTime
+    print 'SnapshotLineage: %.3f sec (%.1fx)' % (newTime, oldTime / max(newTime, 1e-6))
+    if old != new:
+        raise ValueError('SnapshotLineage results differ for %d pairs'
+                         % len(set(old.items()) ^ set(new.items())))
+    if args.memory:
+        print 'inventory of tuples: %d KB' % peak_memory('tuples', args)
+        print 'SnapshotInventory: %d KB' % peak_memory('compact', args)